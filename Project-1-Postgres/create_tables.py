@@ -1,5 +1,7 @@
+import sys
+import getopt
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, create_table_queries_deferred, drop_table_queries
 
 
 def create_database():
@@ -36,11 +38,13 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, queries=create_table_queries):
     """
     Creates each table using the queries in `create_table_queries` list. 
+    For a bulk initial load `create_table_queries_deferred` creates songplays without keys and indexes,
+    they are added by "etl.py --initial-load" after all data is loaded.
     """
-    for query in create_table_queries:
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
@@ -57,11 +61,21 @@ def main():
     - Creates all tables needed. 
     
     - Finally, closes the connection. 
+    
+    Command line options:
+    -i / --initial-load : create songplays without primary key, foreign keys and indexes for a bulk
+                          initial load, run "etl.py --initial-load" afterwards
     """
+    opts, args = getopt.getopt(sys.argv[1:], 'i', ['initial-load'])
+    queries = create_table_queries
+    for o, p in opts:
+        if o in ('-i', '--initial-load'):
+            queries = create_table_queries_deferred
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, queries)
 
     conn.close()
 
@@ -1,21 +1,74 @@
 import os
+import io
+import sys
 import glob
+import hashlib
+import functools
+import getopt
+import collections
 import psycopg2
+import psycopg2.pool
+import psycopg2.extras
+import numpy as np
 import pandas as pd
+from time import time
+from multiprocessing import Pool
 from sql_queries import *
 
 
+sparkifydb_dsn = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+# Connection pool and keyword arguments of a worker process, see "init_worker"
+worker_pool = None
+worker_kwargs = {}
+
+# Columns and types of the song and log files, all other columns are dropped right after reading
+song_dtypes = {
+    "song_id": "object", "title": "object", "artist_id": "object", "year": "Int32", "duration": "float64",
+    "artist_name": "object", "artist_location": "object", "artist_latitude": "float32", "artist_longitude": "float32",
+}
+log_dtypes = {
+    "ts": "int64", "userId": "Int32", "firstName": "object", "lastName": "object", "gender": "category",
+    "level": "category", "song": "object", "artist": "object", "length": "float64", "sessionId": "Int32",
+    "itemInSession": "Int32", "location": "object", "userAgent": "object", "page": "category", "method": "category",
+}
+numeric_dtypes = ("int64", "Int32", "float32", "float64")
+
+# Columns of a log file which are needed by the loaders
+log_columns = ["ts", "userId", "firstName", "lastName", "gender", "level", "song", "artist", "length",
+               "sessionId", "location", "userAgent"]
+
+
+def apply_schema(df, dtypes):
+    """Projects df to the columns of the schema and converts them to the schema types
+    Numbers which cannot be parsed (e.g. the empty userId of logged out users) become missing values
+    Returns the typed dataframe"""
+    df = df.reindex(columns=list(dtypes))
+    for column, dtype in dtypes.items():
+        if dtype in numeric_dtypes:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def read_json(filepath, dtypes):
+    """Reads a json file with one record per line using the given schema (song_dtypes or log_dtypes)
+    Returns the typed dataframe"""
+    return apply_schema(pd.read_json(filepath, lines=True, dtype=False), dtypes)
+
+
 def process_song_file(cur, filepath):
     """Takes the json file provided in filepath and reads the file
     Then song data and artist data are selected and inserted into the corresponding tables"""
     # Open song file using the path variable "filepath" and create a dataframe from it
-    df = pd.read_json(filepath, lines=True)
+    df = read_json(filepath, song_dtypes)
     
     # Insert songs record
     # Select song data columns from df and store in a new dataframe
     songs_table_columns = df[["song_id","title","artist_id","year","duration"]]
     # Select only the values from df and store in a list
-    song_data = songs_table_columns.values[0].tolist()
+    song_data = df_to_rows(songs_table_columns)[0]
     # Write to songs table
     cur.execute(song_table_insert, song_data)
     
@@ -23,52 +76,194 @@ def process_song_file(cur, filepath):
     # Select artist columns and store in new dataframe
     artist_table_columns = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]]
     # Create a list
-    artist_data = artist_table_columns.values[0].tolist()
+    artist_data = df_to_rows(artist_table_columns)[0]
     # Write to artists table
     cur.execute(artist_table_insert, artist_data)
 
 
-def process_log_file(cur, filepath):
-    '''Process the log file provided in filepath and store all song play actions of users:
-    1. Search file for NextSong actions of users
-    2. Collect timestamps of these actions
-    3. Select user data and load them into table users
-    4. Search for song and artists ids in tables songs and artists
-    5. Add recorded song play actions from users to table songplays'''
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+def read_json_files(files, dtypes):
+    """Reads a list of json files (one record per line) with the given schema and combines them
+    Returns one dataframe with the rows of all files"""
+    return pd.concat([read_json(f, dtypes) for f in files], ignore_index=True)
 
-    # filter by NextSong action
-    df = df.query('page == "NextSong"')
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df.ts, unit='ms').sort_values()
-    
-    # insert time data records, with duplicates removed
-    time_data = (t.dt.values, t.dt.hour.values, t.dt.day.values, t.dt.week.values, t.dt.month.values, t.dt.year.values, t.dt.weekday.values)
-    column_labels = ("timestamp", "hour", "day", "week", "month", "year", "weekday")
-    # First a dictionary with all key-value pairs
-    dict_ts = dict(zip(column_labels, time_data))
-    # Then a dataframe from the dictionary
-    time_df = pd.DataFrame.from_dict(dict_ts)
+def df_to_rows(df):
+    """Converts a dataframe into a list of row lists with Python types, missing values become None
+    float32 values are converted via their shortest representation, so 35.14968 is not stored as 35.149681091308594
+    Returns rows that can be passed to psycopg2"""
+    df = df.copy()
+    for column in df.columns[df.dtypes == 'float32']:
+        df[column] = df[column].astype(str).astype('float64')
+    return df.astype(object).where(df.notna(), None).values.tolist()
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
 
-    # load user table
-    user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
-    pd.options.mode.chained_assignment = None
-    user_df['userId'] = pd.to_numeric(user_df['userId'].values.tolist(), errors='ignore')
-    # Clean the data from duplicated and NaN entries, sort the df
-    user_df.dropna(axis=0, inplace=True)
+def process_song_files(cur, files):
+    """Reads a batch of song files into one dataframe and inserts its songs and artists
+    with one multi-row INSERT per table, duplicates within the batch are removed beforehand"""
+    df = read_json_files(files, song_dtypes)
+
+    # Insert song records
+    song_df = df[["song_id", "title", "artist_id", "year", "duration"]].drop_duplicates(subset='song_id')
+    psycopg2.extras.execute_values(cur, song_table_insert_values, df_to_rows(song_df), page_size=max(len(song_df), 1))
+
+    # Insert artist records, one artist usually has several songs in a batch
+    artist_df = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]]
+    artist_df = artist_df.drop_duplicates(subset='artist_id')
+    psycopg2.extras.execute_values(cur, artist_table_insert_values, df_to_rows(artist_df), page_size=max(len(artist_df), 1))
+
+
+def build_time_df(ts):
+    """Converts an array of unique epoch millisecond timestamps into the columns of table time
+    All columns are computed vectorized, the week is the ISO calendar week
+    Returns a dataframe with one row per timestamp"""
+    t = pd.DatetimeIndex(pd.to_datetime(ts, unit='ms'))
+    return pd.DataFrame({
+        'timestamp': t,
+        'hour': t.hour,
+        'day': t.day,
+        'week': t.isocalendar().week.to_numpy(dtype='int64'),
+        'month': t.month,
+        'year': t.year,
+        'weekday': t.weekday,
+    })
+
+
+class TimeDimension:
+    """Time dimension stage: collects event timestamps (e.g. of a batch of log files),
+    de-duplicates them and emits the rows for table time
+    A bounded set of already emitted timestamps makes sure that the same start_time is sent
+    to the database only once per run, the oldest entries are evicted first when max_size is reached
+    Timestamps emitted in a transaction which is rolled back have to be released with method rollback"""
+
+    def __init__(self, max_size=1000000):
+        self.max_size = max_size
+        self.pending = []
+        self.emitted = set()
+        self.order = collections.deque()
+        self.uncommitted = []
+
+    def add(self, ts):
+        """Collects an array of epoch millisecond timestamps"""
+        self.pending.append(np.asarray(ts, dtype='int64'))
+
+    def flush(self):
+        """De-duplicates all collected timestamps and drops those emitted before
+        Returns a dataframe with the new rows of table time"""
+        ts = np.unique(np.concatenate(self.pending)) if self.pending else np.array([], dtype='int64')
+        self.pending = []
+        new = np.fromiter((t not in self.emitted for t in ts.tolist()), dtype=bool, count=len(ts))
+        ts = ts[new]
+        for t in ts.tolist():
+            self.emitted.add(t)
+            self.order.append(t)
+        while len(self.order) > self.max_size:
+            self.emitted.discard(self.order.popleft())
+        self.uncommitted.append(ts)
+        return build_time_df(ts)
+
+    def commit(self):
+        """Called after the emitted rows were committed to the database"""
+        self.uncommitted = []
+
+    def rollback(self):
+        """Forgets the timestamps emitted since the last commit, so they are sent again"""
+        for ts in self.uncommitted:
+            self.emitted.difference_update(ts.tolist())
+        self.order = collections.deque(t for t in self.order if t in self.emitted)
+        self.uncommitted = []
+
+
+# Time dimension stage of this process, shared by all log files of a run
+time_dimension = TimeDimension()
+
+
+def get_time_df(df):
+    """Converts the timestamps of the NextSong actions in df into the columns of table time
+    Timestamps which were already emitted in this run are skipped (see "TimeDimension")
+    Returns a dataframe with one row per new timestamp"""
+    time_dimension.add(df.ts.values)
+    return time_dimension.flush()
+
+
+def get_user_df(df):
+    """Selects the user columns of df, removes rows without user id and duplicates
+    The event timestamp is kept in column "ts" so that the latest level of a user can be determined
+    Returns a dataframe sorted by user id"""
+    user_df = df[["userId", "firstName", "lastName", "gender", "level", "ts"]]
+    # Clean the data from duplicated and NaN entries (userId is already an integer, see log_dtypes), sort the df
+    user_df = user_df.dropna(axis=0)
     user_df = user_df.drop_duplicates()
-    user_df = user_df.sort_values(by='userId')
+    return user_df.sort_values(by='userId')
 
-    # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
 
-    # insert songplay records
+song_key_columns = ['title_key', 'artist_key', 'duration_key']
+
+
+def song_key(title, artist, duration):
+    """Normalizes song title, artist name and duration (pandas series) into the lookup key
+    of the song index: stripped lower case strings and the duration rounded to 2 decimals
+    The duration has to be float64 on both sides (see log_dtypes), a float32 length like 270.99501
+    is stored as 270.9949951171875 and would round to 270.99 instead of 271.0
+    Returns a dataframe with the columns listed in song_key_columns
+
+    >>> length = pd.Series([270.99501, 270.99499], dtype=log_dtypes['length'])
+    >>> print(song_key(pd.Series(['Song ', 'song']), pd.Series(['Artist', 'artist']), length).to_string(index=False))
+    title_key artist_key  duration_key
+         song     artist        271.00
+         song     artist        270.99
+    """
+    return pd.DataFrame({
+        'title_key': title.astype(str).str.strip().str.lower(),
+        'artist_key': artist.astype(str).str.strip().str.lower(),
+        'duration_key': pd.to_numeric(duration, errors='coerce').astype('float64').round(2),
+    }, index=title.index)
+
+
+def make_song_index(songs):
+    """Takes a dataframe with the columns song_id, artist_id, title, name and duration
+    Returns the song index: song and artist id per unique song key"""
+    index = song_key(songs.title, songs.name, songs.duration)
+    index['song_id'] = songs.song_id
+    index['artist_id'] = songs.artist_id
+    return index.drop_duplicates(subset=song_key_columns).reset_index(drop=True)
+
+
+def build_song_index(cur):
+    """Reads all songs and their artists from tables songs and artists (see "song_index_select")
+    Returns the song index used by function resolve_songplays"""
+    cur.execute(song_index_select)
+    songs = pd.DataFrame(cur.fetchall(), columns=['song_id', 'artist_id', 'title', 'name', 'duration'])
+    print('Song index built from database with {} songs'.format(len(songs)))
+    return make_song_index(songs)
+
+
+def resolve_songplays(df, song_index):
+    """Resolves song and artist id of all NextSong actions in df with one hash join on the song index
+    Actions without a matching song are skipped
+    Returns a dataframe with the columns of table songplays"""
+    events = pd.concat([df, song_key(df.song, df.artist, df.length)], axis=1)
+    events = events.merge(song_index, how='inner', on=song_key_columns)
+    return pd.DataFrame({
+        'start_time': pd.to_datetime(events.ts, unit='ms'),
+        'user_id': events.userId,
+        'level': events.level,
+        'song_id': events.song_id,
+        'artist_id': events.artist_id,
+        'session_id': events.sessionId,
+        'location': events.location,
+        'user_agent': events.userAgent,
+    })
+
+
+def get_songplay_df(cur, df, song_index=None):
+    """Looks up song and artist id of every NextSong action in df
+    With a song index (see "build_song_index") the lookup is one merge for the whole dataframe,
+    without it "song_select" is run for every action
+    Actions without a matching song are skipped
+    Returns a dataframe with the columns of table songplays"""
+    if song_index is not None:
+        return resolve_songplays(df, song_index)
+    songplays = []
     for index, row in df.iterrows():
         
         # First get song title, artist name and song length and run SELECT for 
@@ -76,49 +271,367 @@ def process_log_file(cur, filepath):
         cur.execute(song_select, selectors)
         results = cur.fetchone()
         
-        # If the SELECT yields any results, complete the dataset and insert it into the table
+        # If the SELECT yields any results, complete the dataset
         if results:
             # Store song and artist ids from the SELECT separately
             songid, artistid = results
-            # insert songplay record
             # Convert the timestamps to datetime
-            row.ts = pd.to_datetime(row.ts, unit='ms')
+            ts = pd.to_datetime(row.ts, unit='ms')
             # Copy all other required fields including songid, artistid and timestamp
-            songplay_data = (row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-            # Write to table
-            cur.execute(songplay_table_insert, songplay_data)
-        else:
-            songid, artistid = None, None
+            songplays.append((ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent))
+    column_labels = ("start_time", "user_id", "level", "song_id", "artist_id", "session_id", "location", "user_agent")
+    return pd.DataFrame.from_records(songplays, columns=column_labels)
 
 
-def process_data(cur, conn, filepath, func):
-    """Recursively search given filepath and process all json files.
-    Calls for each file the function "func" (which is either directing from here to "process_song_file" or "process_log_file
-    Nothing returned from here, but the changes from the sub-functions are committed"""
-    # et all files matching extension from directory
+def process_log_file(cur, filepath, song_index=None):
+    '''Process the log file provided in filepath and store all song play actions of users:
+    1. Search file for NextSong actions of users
+    2. Collect timestamps of these actions
+    3. Select user data and load them into table users
+    4. Search for song and artists ids in tables songs and artists
+    5. Add recorded song play actions from users to table songplays
+    If a song index is given, step 4 is resolved in memory instead of querying the database'''
+    # open log file
+    df = read_json(filepath, log_dtypes)
+
+    # filter by NextSong action
+    df = df.query('page == "NextSong"')
+
+    # insert time data records
+    time_df = get_time_df(df)
+    for i, row in time_df.iterrows():
+        cur.execute(time_table_insert, list(row))
+
+    # load user table, the timestamp is not needed for row-wise inserts
+    user_df = get_user_df(df).drop(columns='ts').drop_duplicates()
+
+    # insert user records
+    for i, row in user_df.iterrows():
+        cur.execute(user_table_insert, list(row))
+
+    # insert songplay records
+    songplay_df = get_songplay_df(cur, df, song_index)
+    for i, row in songplay_df.iterrows():
+        cur.execute(songplay_table_insert, list(row))
+
+
+def bulk_load(cur, table, df):
+    """Streams the dataframe into a temporary staging table via COPY FROM STDIN and merges
+    it into the target table with INSERT ... SELECT ... ON CONFLICT (see "bulk_load_queries")
+    The column order of df has to match the staging table
+    Returns the number of rows sent to the database"""
+    stage, stage_create, merge = bulk_load_queries[table]
+    t0 = time()
+    # Serialize the dataframe as csv into memory, empty values become NULL
+    buffer = io.StringIO()
+    df.to_csv(buffer, header=False, index=False)
+    buffer.seek(0)
+    # Copy to the staging table and merge into the target table
+    cur.execute(stage_create)
+    cur.copy_expert(stage_copy.format(stage), buffer)
+    cur.execute(merge)
+    merged = cur.rowcount
+    cur.execute(stage_drop.format(stage))
+    runtime = max(time() - t0, 1e-6)
+    print('{}: {} rows copied, {} rows merged ({:.0f} rows/s)'.format(table, len(df), merged, len(df) / runtime))
+    return len(df)
+
+
+def load_log_frame_bulk(cur, df, song_index=None):
+    '''Loads the NextSong actions in df into tables time, users and songplays with one COPY
+    and one merge statement per table'''
+    bulk_load(cur, 'time', get_time_df(df))
+    bulk_load(cur, 'users', get_user_df(df))
+    bulk_load(cur, 'songplays', get_songplay_df(cur, df, song_index))
+
+
+def process_log_file_bulk(cur, filepath, song_index=None):
+    '''Same as "process_log_file" but loads tables time, users and songplays with one COPY
+    and one merge statement per table instead of one INSERT per row'''
+    # open log file and filter by NextSong action
+    df = read_json(filepath, log_dtypes)
+    df = df.query('page == "NextSong"')
+    load_log_frame_bulk(cur, df, song_index)
+
+
+def read_log_chunks(filepath, chunksize):
+    '''Reads a newline-delimited json log file in chunks of chunksize lines
+    Each chunk is filtered by NextSong action and projected to the columns in log_columns
+    Yields one dataframe per chunk, so memory usage does not depend on the file size'''
+    with pd.read_json(filepath, lines=True, dtype=False, chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunk = apply_schema(chunk, log_dtypes)
+            chunk = chunk[chunk.page == "NextSong"]
+            yield chunk[log_columns]
+
+
+def process_log_file_stream(cur, filepath, song_index=None, chunksize=100000):
+    '''Same as "process_log_file_bulk" but streams the file in chunks of chunksize lines,
+    every chunk is loaded before the next one is read'''
+    for df in read_log_chunks(filepath, chunksize):
+        if len(df):
+            load_log_frame_bulk(cur, df, song_index)
+
+
+def process_log_files_bulk(cur, files, song_index=None):
+    '''Same as "process_log_file_bulk" for a batch of log files which are combined into one dataframe,
+    so timestamps are de-duplicated across all files of the batch before they are sent'''
+    df = read_json_files(files, log_dtypes)
+    df = df.query('page == "NextSong"')
+    load_log_frame_bulk(cur, df, song_index)
+
+
+def get_files(filepath):
+    """Recursively search given filepath for json files
+    Returns a list of absolute file paths"""
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root,'*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
+    return all_files
+
+
+def file_hash(filepath):
+    """Returns the md5 hex digest of the file content"""
+    digest = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def list_files(cur, filepath, incremental=True):
+    """Searches filepath for json files and compares them with the manifest in table loaded_files
+    A file is skipped if path, size and modification time are unchanged, if only the modification
+    time changed but the content hash is the same, the manifest entry is updated (and committed) and the file skipped
+    Without incremental all files are returned and not hashed, their manifest rows get an empty hash,
+    so a later incremental run reprocesses them once their modification time changes
+    Returns the list of files to process and a dictionary with their manifest rows"""
+    all_files = get_files(filepath)
+    loaded = {}
+    if incremental:
+        cur.execute(loaded_files_select)
+        loaded = {row[0]: row[1:] for row in cur.fetchall()}
+
+    files, manifest, touched = [], {}, []
+    for datafile in all_files:
+        stat = os.stat(datafile)
+        known = loaded.get(datafile)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            continue
+        row = (datafile, stat.st_size, stat.st_mtime, file_hash(datafile) if incremental else '')
+        if known and known[2] == row[3]:
+            touched.append(row)
+            continue
+        files.append(datafile)
+        manifest[datafile] = row
+    if touched:
+        psycopg2.extras.execute_values(cur, loaded_files_insert, touched)
+        # Commit now, the loaders only commit when a file is processed
+        cur.connection.commit()
+    if incremental:
+        print('{} of {} files in {} are new or changed'.format(len(files), len(all_files), filepath))
+    return files, manifest
+
+
+def record_loaded_files(cur, manifest, files):
+    """Writes the manifest rows of the processed files to table loaded_files
+    Has to run in the same transaction as the load of the files"""
+    if isinstance(files, str):
+        files = [files]
+    psycopg2.extras.execute_values(cur, loaded_files_insert, [manifest[f] for f in files])
+
+
+def process_data(cur, conn, filepath, func, incremental=True):
+    """Recursively search given filepath and process all json files.
+    Calls for each file the function "func" (which is either directing from here to "process_song_file" or "process_log_file
+    With incremental only new or changed files are processed (see "list_files")
+    Nothing returned from here, but the changes from the sub-functions are committed"""
+    # et all files matching extension from directory
+    all_files, manifest = list_files(cur, filepath, incremental)
 
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
     # iterate over files and process
+    t0 = time()
     for i, datafile in enumerate(all_files, 1):
         func(cur, datafile)
+        record_loaded_files(cur, manifest, datafile)
         conn.commit()
+        time_dimension.commit()
         print('{}/{} files processed.'.format(i, num_files))
+    print('{} files processed in {:.1f}s ({:.1f} files/s)'.format(num_files, time() - t0, num_files / max(time() - t0, 1e-6)))
+
+
+def process_data_batched(cur, conn, filepath, func, batch_size, incremental=True):
+    """Same as "process_data" but hands the files to "func" in batches of batch_size files
+    (e.g. "process_song_files") and commits once per batch
+    Throughput in files per second is printed per batch and for the whole run"""
+    all_files, manifest = list_files(cur, filepath, incremental)
+    num_files = len(all_files)
+    print('{} files found in {}, processing in batches of {}'.format(num_files, filepath, batch_size))
+
+    t0 = time()
+    for start in range(0, num_files, batch_size):
+        batch = all_files[start:start + batch_size]
+        t1 = time()
+        func(cur, batch)
+        record_loaded_files(cur, manifest, batch)
+        conn.commit()
+        time_dimension.commit()
+        print('{}/{} files processed ({:.1f} files/s).'.format(start + len(batch), num_files, len(batch) / max(time() - t1, 1e-6)))
+    print('{} files processed in {:.1f}s ({:.1f} files/s)'.format(num_files, time() - t0, num_files / max(time() - t0, 1e-6)))
 
 
-def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+def init_worker(dsn, kwargs):
+    """Runs once in every worker process of "process_data_parallel"
+    Opens the connection pool of the worker and stores the keyword arguments
+    (e.g. the song index) which are passed to every call of the processing function"""
+    global worker_pool, worker_kwargs
+    worker_pool = psycopg2.pool.SimpleConnectionPool(1, 1, dsn)
+    worker_kwargs = kwargs
+
+
+def process_file_in_worker(task, retries=3):
+    """Processes one file with the connection of the worker process and commits it
+    Transactions aborted by a deadlock between workers are rolled back and retried
+    Returns the processed file path (or list of file paths)"""
+    func, datafile, manifest = task
+    conn = worker_pool.getconn()
+    try:
+        for attempt in range(1, retries + 1):
+            try:
+                cur = conn.cursor()
+                func(cur, datafile, **worker_kwargs)
+                record_loaded_files(cur, manifest, datafile)
+                conn.commit()
+                time_dimension.commit()
+                break
+            except psycopg2.extensions.TransactionRollbackError:
+                conn.rollback()
+                time_dimension.rollback()
+                if attempt == retries:
+                    raise
+            except Exception:
+                conn.rollback()
+                time_dimension.rollback()
+                raise
+    finally:
+        worker_pool.putconn(conn)
+    return datafile
+
+
+def process_data_parallel(dsn, filepath, func, workers, batch_size=None, incremental=True, **kwargs):
+    """Same as "process_data" but spreads the files across a pool of worker processes
+    Every worker has its own database connection and commits each file on its own
+    With a batch_size "func" receives lists of files instead (see "process_data_batched")
+    Progress is reported in the order of the file list
+    Returns after all files are processed"""
+    conn = psycopg2.connect(dsn)
+    all_files, manifest = list_files(conn.cursor(), filepath, incremental)
+    conn.commit()
+    conn.close()
+    num_files = len(all_files)
+    print('{} files found in {}, processing with {} workers'.format(num_files, filepath, workers))
+
+    if batch_size:
+        tasks = []
+        for i in range(0, num_files, batch_size):
+            batch = all_files[i:i + batch_size]
+            tasks.append((func, batch, {f: manifest[f] for f in batch}))
+        chunksize = 1
+    else:
+        tasks = [(func, datafile, {datafile: manifest[datafile]}) for datafile in all_files]
+        # Hand out the files in chunks to keep the overhead per file low
+        chunksize = max(1, min(64, num_files // (workers * 4)))
+    t0 = time()
+    done = 0
+    with Pool(workers, initializer=init_worker, initargs=(dsn, kwargs)) as pool:
+        for datafile in pool.imap(process_file_in_worker, tasks, chunksize):
+            done += len(datafile) if batch_size else 1
+            print('{}/{} files processed.'.format(done, num_files))
+    print('{} files processed in {:.1f}s ({:.1f} files/s)'.format(num_files, time() - t0, num_files / max(time() - t0, 1e-6)))
+
+
+def finish_initial_load(cur, conn):
+    """Builds the primary key, foreign keys and indexes of songplays after a bulk initial load
+    into tables created with "create_tables.py --initial-load" and refreshes the planner statistics"""
+    for query in finish_initial_load_queries:
+        t0 = time()
+        cur.execute(query)
+        conn.commit()
+        print('{} ({:.1f}s)'.format(query.strip(), time() - t0))
+
+
+def main(argv=None):
+    """Loads song files and log files into sparkifydb
+    Command line options:
+    -b / --bulk : load tables time, users and songplays using COPY instead of row-wise INSERTs
+    -w N / --workers N : process the files with N worker processes, song files are always
+                         finished before the first log file is processed
+    -c N / --chunk-size N : read song files in batches of N files and write each batch with
+                            one multi-row INSERT per table (e.g. 5000), together with --bulk
+                            log files are combined into batches of N files as well
+    -s N / --stream N : read log files in chunks of N lines and load each chunk with COPY,
+                        memory usage stays flat for arbitrarily large log files
+    -i / --initial-load : build keys, foreign keys and indexes of songplays and run ANALYZE after
+                          the load, use after "create_tables.py --initial-load"
+    -f / --full : process all files, by default files found in table loaded_files with unchanged
+                  size, modification time or content are skipped"""
+    opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 'bw:c:s:if', ['bulk', 'workers=', 'chunk-size=', 'stream=', 'initial-load', 'full'])
+    log_func = process_log_file
+    workers = 1
+    chunk_size = None
+    incremental = True
+    stream_size = None
+    initial_load = False
+    for o, p in opts:
+        if o in ('-b', '--bulk'):
+            log_func = process_log_file_bulk
+        if o in ('-w', '--workers'):
+            workers = int(p)
+        if o in ('-c', '--chunk-size'):
+            chunk_size = int(p)
+        if o in ('-f', '--full'):
+            incremental = False
+        if o in ('-s', '--stream'):
+            stream_size = int(p)
+        if o in ('-i', '--initial-load'):
+            initial_load = True
+    if stream_size:
+        log_func = functools.partial(process_log_file_stream, chunksize=stream_size)
+
+    conn = psycopg2.connect(sparkifydb_dsn)
     cur = conn.cursor()
+    # Databases created before the manifest was introduced do not have the table yet
+    cur.execute(loaded_files_table_create)
+    conn.commit()
+
+    song_func = process_song_files if chunk_size else process_song_file
+    if workers > 1:
+        process_data_parallel(sparkifydb_dsn, 'data/song_data', song_func, workers, batch_size=chunk_size, incremental=incremental)
+    elif chunk_size:
+        process_data_batched(cur, conn, 'data/song_data', song_func, chunk_size, incremental)
+    else:
+        process_data(cur, conn, filepath='data/song_data', func=song_func, incremental=incremental)
+
+    # All songs are loaded now, so songplays can be resolved in memory instead of one query per event
+    song_index = build_song_index(cur)
+    log_batch_size = chunk_size if log_func is process_log_file_bulk else None
+    if log_batch_size:
+        log_func = process_log_files_bulk
+    if workers > 1:
+        process_data_parallel(sparkifydb_dsn, 'data/log_data', log_func, workers, batch_size=log_batch_size, incremental=incremental, song_index=song_index)
+    elif log_batch_size:
+        process_data_batched(cur, conn, 'data/log_data', functools.partial(log_func, song_index=song_index), log_batch_size, incremental)
+    else:
+        process_data(cur, conn, filepath='data/log_data', func=functools.partial(log_func, song_index=song_index), incremental=incremental)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    if initial_load:
+        finish_initial_load(cur, conn)
 
     conn.close()
 
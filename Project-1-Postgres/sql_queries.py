@@ -5,10 +5,11 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+loaded_files_table_drop = "DROP TABLE IF EXISTS loaded_files;"
 
 # CREATE TABLES
 
-user_table_create = ("""CREATE TABLE IF NOT EXISTS users (user_id FLOAT PRIMARY KEY, first_name VARCHAR, last_name VARCHAR, gender VARCHAR, level VARCHAR);
+user_table_create = ("""CREATE TABLE IF NOT EXISTS users (user_id INT PRIMARY KEY, first_name VARCHAR, last_name VARCHAR, gender VARCHAR, level VARCHAR);
 """)
 
 song_table_create = ("""CREATE TABLE IF NOT EXISTS songs (song_id VARCHAR PRIMARY KEY, title VARCHAR NOT NULL, artist_id VARCHAR, year INT, duration FLOAT);
@@ -20,12 +21,42 @@ artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists (artist_id VARCHAR
 time_table_create = ("""CREATE TABLE IF NOT EXISTS time (start_time TIMESTAMP PRIMARY KEY, hour INT, day INT, week INT, month INT, year INT, weekday INT);
 """)
 
-songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id SERIAL PRIMARY KEY, start_time TIMESTAMP NOT NULL, user_id VARCHAR NOT NULL, level VARCHAR, song_id VARCHAR NOT NULL, artist_id VARCHAR NOT NULL, session_id VARCHAR, location VARCHAR, user_agent VARCHAR);
+songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id SERIAL PRIMARY KEY, start_time TIMESTAMP NOT NULL, user_id INT NOT NULL, level VARCHAR, song_id VARCHAR NOT NULL, artist_id VARCHAR NOT NULL, session_id VARCHAR, location VARCHAR, user_agent VARCHAR);
 """)
 
-songplay_table_fkalter = ("""ALTER TABLE songplays ADD CONSTRAINT fk_start FOREIGN KEY (start_time) REFERENCES time (start_time), ADD CONSTRAINT fk_songs FOREIGN KEY (song_id) REFERENCES songs (song_id), ADD CONSTRAINT fk_artist FOREIGN KEY (artist_id) REFERENCES artists (artist_id), ADD CONSTRAINT fk_user FOREIGN KEY (user_id) REFERENCES users (user_id)
+# Bulk initial load: songplays is created without any key or index, they are built after the load (see "finish_initial_load_queries")
+# The dimension tables keep their primary keys because the upserts (ON CONFLICT) depend on them
+songplay_table_create_deferred = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id SERIAL, start_time TIMESTAMP NOT NULL, user_id INT NOT NULL, level VARCHAR, song_id VARCHAR NOT NULL, artist_id VARCHAR NOT NULL, session_id VARCHAR, location VARCHAR, user_agent VARCHAR);
 """)
 
+# Manifest of processed source files, used by etl.py to skip files which were loaded before
+loaded_files_table_create = ("""CREATE TABLE IF NOT EXISTS loaded_files (path VARCHAR PRIMARY KEY, size BIGINT NOT NULL, mtime DOUBLE PRECISION NOT NULL, content_hash VARCHAR NOT NULL, loaded_at TIMESTAMP NOT NULL DEFAULT now());
+""")
+
+# A constraint is only added if pg_constraint has no matching one, so reruns and tables created without
+# "--initial-load" (primary key already there) do not fail
+songplay_constraint_add = ("""DO $$ BEGIN IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'songplays'::regclass AND {0}) THEN ALTER TABLE songplays ADD {1}; END IF; END $$;
+""")
+
+songplay_table_fkalter = ''.join(songplay_constraint_add.format("conname = '{}'".format(name), 'CONSTRAINT {} {}'.format(name, key)) for name, key in [
+    ('fk_start', 'FOREIGN KEY (start_time) REFERENCES time (start_time)'),
+    ('fk_songs', 'FOREIGN KEY (song_id) REFERENCES songs (song_id)'),
+    ('fk_artist', 'FOREIGN KEY (artist_id) REFERENCES artists (artist_id)'),
+    ('fk_user', 'FOREIGN KEY (user_id) REFERENCES users (user_id)'),
+])
+
+songplay_table_pkalter = songplay_constraint_add.format("contype = 'p'", 'PRIMARY KEY (songplay_id)')
+
+# INDEXES AND STATISTICS
+
+songplay_start_time_index = ("""CREATE INDEX IF NOT EXISTS songplays_start_time_idx ON songplays (start_time);
+""")
+
+songplay_user_id_index = ("""CREATE INDEX IF NOT EXISTS songplays_user_id_idx ON songplays (user_id);
+""")
+
+analyze_tables = "ANALYZE;"
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING
@@ -43,12 +74,64 @@ artist_table_insert = ("""INSERT INTO artists (artist_id, name, location, latitu
 time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday) VALUES (%s, %s, %s, %s, %s,%s,%s) ON CONFLICT DO NOTHING
 """)
 
+# LOADED FILES MANIFEST
+
+loaded_files_select = ("""SELECT path, size, mtime, content_hash FROM loaded_files;
+""")
+
+loaded_files_insert = ("""INSERT INTO loaded_files (path, size, mtime, content_hash) VALUES %s ON CONFLICT (path) DO UPDATE SET size = EXCLUDED.size, mtime = EXCLUDED.mtime, content_hash = EXCLUDED.content_hash, loaded_at = now()
+""")
+
+# MULTI-ROW INSERTS (used with psycopg2.extras.execute_values, %s is replaced by all rows of a batch)
+
+song_table_insert_values = ("""INSERT INTO songs (song_id, title, artist_id, year, duration) VALUES %s ON CONFLICT (song_id) DO NOTHING
+""")
+
+artist_table_insert_values = ("""INSERT INTO artists (artist_id, name, location, latitude, longitude) VALUES %s ON CONFLICT (artist_id) DO NOTHING
+""")
+
+# BULK LOAD (COPY into temporary staging tables, then merge into the target tables)
+
+time_stage_create = ("""CREATE TEMP TABLE time_stage (start_time TIMESTAMP, hour INT, day INT, week INT, month INT, year INT, weekday INT);
+""")
+
+user_stage_create = ("""CREATE TEMP TABLE users_stage (user_id INT, first_name VARCHAR, last_name VARCHAR, gender VARCHAR, level VARCHAR, ts BIGINT);
+""")
+
+songplay_stage_create = ("""CREATE TEMP TABLE songplays_stage (start_time TIMESTAMP, user_id INT, level VARCHAR, song_id VARCHAR, artist_id VARCHAR, session_id VARCHAR, location VARCHAR, user_agent VARCHAR);
+""")
+
+stage_copy = ("""COPY {} FROM STDIN WITH (FORMAT csv)
+""")
+
+stage_drop = "DROP TABLE IF EXISTS {};"
+
+time_table_merge = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday) SELECT start_time, hour, day, week, month, year, weekday FROM time_stage ON CONFLICT DO NOTHING
+""")
+
+# Only the latest event per user may reach ON CONFLICT DO UPDATE, so the most recent level wins
+user_table_merge = ("""INSERT INTO users (user_id, first_name, last_name, gender, level) SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender, level FROM users_stage WHERE user_id IS NOT NULL ORDER BY user_id, ts DESC ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level
+""")
+
+songplay_table_merge = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent FROM songplays_stage ON CONFLICT DO NOTHING
+""")
+
 # FIND SONGS
 
 song_select = ("""SELECT s.song_id, a.artist_id FROM songs s JOIN artists a ON s.artist_id = a.artist_id WHERE s.title LIKE %s AND a.name LIKE %s AND s.duration = %s;
 """)
 
+song_index_select = ("""SELECT s.song_id, a.artist_id, s.title, a.name, s.duration FROM songs s JOIN artists a ON s.artist_id = a.artist_id;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, loaded_files_table_create]
+create_table_queries_deferred = [songplay_table_create_deferred, user_table_create, song_table_create, artist_table_create, time_table_create, loaded_files_table_create]
+finish_initial_load_queries = [songplay_table_pkalter, songplay_table_fkalter, songplay_start_time_index, songplay_user_id_index, analyze_tables]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, loaded_files_table_drop]
+bulk_load_queries = {
+    'time': ('time_stage', time_stage_create, time_table_merge),
+    'users': ('users_stage', user_stage_create, user_table_merge),
+    'songplays': ('songplays_stage', songplay_stage_create, songplay_table_merge),
+}
\ No newline at end of file
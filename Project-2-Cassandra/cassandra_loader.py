@@ -0,0 +1,320 @@
+import csv
+import sys
+import math
+import getopt
+import threading
+from collections import namedtuple
+from time import time, perf_counter
+from datetime import datetime
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
+from cassandra.query import BatchStatement, BatchType
+from cassandra.concurrent import execute_concurrent_with_args
+
+
+"""The module "cassandra_loader.py" loads event_datafile_new.csv into the query tables of the notebook:
+- Every INSERT is prepared once per table
+- Rows are sent with execute_async, the number of requests in flight is limited by a window,
+  reading the file pauses while the window is full (back-pressure)
+- Inserts per second and latency percentiles are reported per table
+- "load_all" reads the file once and fans every row out to all registered query tables
+- With batching, rows are grouped by partition key and sent as UNLOGGED batches touching a single
+  partition, the token-aware load balancing policy routes each batch straight to a replica
+"""
+
+keyspace_create = "CREATE KEYSPACE IF NOT EXISTS {} WITH replication = {{'class': 'SimpleStrategy', 'replication_factor' : 1}};"
+
+# One row of event_datafile_new.csv with typed values
+Event = namedtuple('Event', ['artist', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                             'level', 'location', 'sessionId', 'song', 'userId'])
+
+# Registered query tables: create statement, prepared insert, the insert values taken from an Event
+# and the positions of the partition key columns within the insert values
+query_tables = {}
+
+
+def register_table(name, create, insert, params, partition):
+    """Adds a query table to query_tables, params is a function returning the insert values of an Event,
+    partition lists the positions of the partition key columns in these values (used for batching)
+    All registered tables are filled by the same pass over the csv file (see "load_all")"""
+    query_tables[name] = {'create': create, 'insert': insert, 'params': params, 'partition': partition}
+
+
+register_table(
+    'artistTitle_by_sessiondata',
+    "CREATE TABLE IF NOT EXISTS artistTitle_by_sessiondata (sessionId int, itemInSession int, artist text, song_title text, song_length float, PRIMARY KEY (sessionId, itemInSession))",
+    "INSERT INTO artistTitle_by_sessiondata (sessionId, itemInSession, artist, song_title, song_length) VALUES (?, ?, ?, ?, ?)",
+    lambda e: (e.sessionId, e.itemInSession, e.artist, e.song, e.length), (0,))
+register_table(
+    'artistTitle_by_userSession',
+    "CREATE TABLE IF NOT EXISTS artistTitle_by_userSession (sessionId int, userId int, itemInSessions int, artist text, song_title text, user_first text, user_last text, PRIMARY KEY ((sessionId, userId), itemInSessions))",
+    "INSERT INTO artistTitle_by_userSession (sessionId, userId, itemInSessions, artist, song_title, user_first, user_last) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    lambda e: (e.sessionId, e.userId, e.itemInSession, e.artist, e.song, e.firstName, e.lastName), (0, 1))
+register_table(
+    'user_by_title',
+    "CREATE TABLE IF NOT EXISTS user_by_title (song_title text, sessionId int, itemInSessions int, artist text, song_length float, userId int, user_first text, user_last text, PRIMARY KEY ((song_title), userId))",
+    "INSERT INTO user_by_title (song_title, sessionId, itemInSessions, artist, song_length, userId, user_first, user_last) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+    lambda e: (e.song, e.sessionId, e.itemInSession, e.artist, e.length, e.userId, e.firstName, e.lastName), (0,))
+
+
+def parse_event(line):
+    """Converts one csv line (list of strings) into an Event with int and float columns
+    Returns the Event"""
+    return Event(line[0], line[1], line[2], int(line[3]), line[4], float(line[5]),
+                 line[6], line[7], int(line[8]), line[9], int(line[10]))
+
+
+def read_events(file):
+    """Reads the csv file written by the pre-processing part of the notebook, or a list of
+    such files (e.g. the shards written by "consolidate_events.py")
+    Yields one Event per line, the header of every file is skipped"""
+    for path in ([file] if isinstance(file, str) else file):
+        with open(path, encoding='utf8') as f:
+            csvreader = csv.reader(f)
+            next(csvreader)
+            for line in csvreader:
+                yield parse_event(line)
+
+
+def percentile(values, p):
+    """Returns the p-th percentile (0-100) of a list of numbers using the nearest rank"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, math.ceil(p / 100.0 * len(values)) - 1))
+    return values[rank]
+
+
+class AsyncLoader:
+    """Sends one prepared statement with execute_async and at most "concurrency" requests in flight
+    "insert" blocks while the window is full, so a fast reader cannot queue up the whole file in memory
+    Latency of every request and failed requests are recorded for the report"""
+
+    def __init__(self, session, cql, concurrency=128):
+        self.session = session
+        self.statement = session.prepare(cql)
+        self.concurrency = concurrency
+        self.window = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = []
+        self.sent = 0
+        self.requests = 0
+        self.t0 = time()
+
+    def insert(self, params):
+        """Sends one row, waits for a free slot in the window first"""
+        self.send(self.statement, params)
+
+    def send(self, statement, params=None, rows=1):
+        """Sends any statement (e.g. a batch of rows rows), waits for a free slot in the window first"""
+        self.window.acquire()
+        self.sent += rows
+        self.requests += 1
+        started = perf_counter()
+        future = self.session.execute_async(statement, params)
+        future.add_callbacks(self._done, self._failed, callback_args=(started,), errback_args=(started,))
+
+    def _done(self, result, started):
+        with self.lock:
+            self.latencies.append(perf_counter() - started)
+        self.window.release()
+
+    def _failed(self, error, started):
+        with self.lock:
+            self.errors.append(error)
+        self.window.release()
+
+    def wait(self):
+        """Blocks until all requests in flight are answered"""
+        for i in range(self.concurrency):
+            self.window.acquire()
+        for i in range(self.concurrency):
+            self.window.release()
+
+    def stats(self):
+        """Returns a dictionary with the number of rows, errors, inserts per second and latency percentiles in ms"""
+        runtime = max(time() - self.t0, 1e-6)
+        with self.lock:
+            latencies = list(self.latencies)
+            errors = len(self.errors)
+        return {
+            'rows': self.sent, 'requests': self.requests, 'errors': errors, 'seconds': round(runtime, 3),
+            'inserts_per_s': round(self.sent / runtime, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        }
+
+
+class BatchWriter:
+    """Groups the rows of one query table by partition key and sends them as UNLOGGED batches
+    through an AsyncLoader, every batch touches a single partition and holds at most max_rows rows
+    or about max_bytes of values (Cassandra warns about batches above 5 KB by default)
+    At most max_buffered rows are kept in memory, above that all partitions are flushed
+    Has the same interface as AsyncLoader: insert, wait and stats"""
+
+    def __init__(self, session, cql, partition, concurrency=128, max_rows=100, max_bytes=5000, max_buffered=100000):
+        self.loader = AsyncLoader(session, cql, concurrency)
+        self.partition = partition
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_buffered = max_buffered
+        self.buffers = {}
+        self.buffered = 0
+
+    def insert(self, params):
+        """Adds one row to the buffer of its partition, full buffers are sent right away"""
+        key = tuple(params[i] for i in self.partition)
+        rows, size = self.buffers.get(key, ([], 0))
+        rows.append(params)
+        size += sum(len(v) if isinstance(v, str) else 8 for v in params)
+        self.buffered += 1
+        if len(rows) >= self.max_rows or size >= self.max_bytes:
+            self._send(key, rows)
+        else:
+            self.buffers[key] = (rows, size)
+        if self.buffered >= self.max_buffered:
+            self.flush()
+
+    def _send(self, key, rows):
+        # The batch takes keyspace and routing key from its first statement, so the
+        # token-aware policy can route it to a replica of the partition
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for params in rows:
+            batch.add(self.loader.statement, params)
+        self.buffers.pop(key, None)
+        self.buffered -= len(rows)
+        self.loader.send(batch, rows=len(rows))
+
+    def flush(self):
+        """Sends the buffers of all partitions"""
+        for key, (rows, size) in list(self.buffers.items()):
+            self._send(key, rows)
+
+    def wait(self):
+        """Sends the remaining rows and blocks until all requests in flight are answered"""
+        self.flush()
+        self.loader.wait()
+
+    def stats(self):
+        """Returns the load statistics, see AsyncLoader.stats"""
+        return self.loader.stats()
+
+
+def connect(host='127.0.0.1'):
+    """Connects to the cluster with a token-aware load balancing policy, so every request
+    is sent to a replica of the partition it writes
+    Returns cluster and session"""
+    profile = ExecutionProfile(load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+    cluster = Cluster([host], execution_profiles={EXEC_PROFILE_DEFAULT: profile})
+    return cluster, cluster.connect()
+
+
+def create_tables(session, tables=None):
+    """Creates the query tables (all tables in query_tables by default)"""
+    for table in tables or query_tables:
+        session.execute(query_tables[table]['create'])
+
+
+def load_table(session, table, file, concurrency=128):
+    """Loads the csv file into one query table with an AsyncLoader
+    Returns the load statistics"""
+    loader = AsyncLoader(session, query_tables[table]['insert'], concurrency)
+    params = query_tables[table]['params']
+    for event in read_events(file):
+        loader.insert(params(event))
+    loader.wait()
+    stats = loader.stats()
+    print(datetime.now(), ': Loaded {} rows into {} ({} inserts/s, p99 {} ms, {} errors)'.format(
+        stats['rows'], table, stats['inserts_per_s'], stats['p99_ms'], stats['errors']))
+    return stats
+
+
+def load_table_concurrent(session, table, file, concurrency=128, chunk_size=10000):
+    """Loads the csv file into one query table with execute_concurrent_with_args, which keeps
+    "concurrency" requests in flight, the file is passed in chunks of chunk_size rows
+    Returns the load statistics (without latency percentiles, the driver does not expose them here)"""
+    statement = session.prepare(query_tables[table]['insert'])
+    params = query_tables[table]['params']
+    t0 = time()
+    rows, errors, chunk = 0, 0, []
+    for event in read_events(file):
+        chunk.append(params(event))
+        if len(chunk) == chunk_size:
+            results = execute_concurrent_with_args(session, statement, chunk, concurrency=concurrency, raise_on_first_error=False)
+            errors += sum(1 for success, result in results if not success)
+            rows += len(chunk)
+            chunk = []
+    if chunk:
+        results = execute_concurrent_with_args(session, statement, chunk, concurrency=concurrency, raise_on_first_error=False)
+        errors += sum(1 for success, result in results if not success)
+        rows += len(chunk)
+    runtime = max(time() - t0, 1e-6)
+    stats = {'rows': rows, 'errors': errors, 'seconds': round(runtime, 3), 'inserts_per_s': round(rows / runtime, 1)}
+    print(datetime.now(), ': Loaded {} rows into {} ({} inserts/s, {} errors)'.format(rows, table, stats['inserts_per_s'], errors))
+    return stats
+
+
+def load_all(session, file, tables=None, concurrency=128, batch_rows=None):
+    """Reads the csv file once and sends every Event to the prepared inserts of all query tables
+    (or the given tables), each table has its own window of "concurrency" requests in flight
+    With batch_rows the rows are sent in UNLOGGED batches per partition (see "BatchWriter")
+    Returns a dictionary with the load statistics per table"""
+    tables = tables or list(query_tables)
+    loaders = []
+    for table in tables:
+        if batch_rows:
+            loader = BatchWriter(session, query_tables[table]['insert'], query_tables[table]['partition'], concurrency, batch_rows)
+        else:
+            loader = AsyncLoader(session, query_tables[table]['insert'], concurrency)
+        loaders.append((table, loader, query_tables[table]['params']))
+    for event in read_events(file):
+        for table, loader, params in loaders:
+            loader.insert(params(event))
+    results = {}
+    for table, loader, params in loaders:
+        loader.wait()
+        results[table] = stats = loader.stats()
+        print(datetime.now(), ': Loaded {} rows into {} ({} inserts/s, p99 {} ms, {} errors)'.format(
+            stats['rows'], table, stats['inserts_per_s'], stats['p99_ms'], stats['errors']))
+    return results
+
+
+def main(argv=None):
+    """Creates keyspace and query tables and loads the csv file into every table in a single pass
+    Command line options:
+    -f FILE / --file FILE : csv file, default "event_datafile_new.csv" (option can be repeated)
+    -k NAME / --keyspace NAME : keyspace, default "events"
+    -h HOST / --host HOST : contact point, default 127.0.0.1
+    -c N / --concurrency N : requests in flight per table, default 128
+    -t TABLE / --table TABLE : load only this table (option can be repeated)
+    -b N / --batch N : send UNLOGGED batches of up to N rows per partition"""
+    opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 'f:k:h:c:t:b:',
+                               ['file=', 'keyspace=', 'host=', 'concurrency=', 'table=', 'batch='])
+    files, keyspace, host, concurrency, tables, batch_rows = [], 'events', '127.0.0.1', 128, [], None
+    for o, p in opts:
+        if o in ('-f', '--file'):
+            files.append(p)
+        if o in ('-k', '--keyspace'):
+            keyspace = p
+        if o in ('-h', '--host'):
+            host = p
+        if o in ('-c', '--concurrency'):
+            concurrency = int(p)
+        if o in ('-t', '--table'):
+            tables.append(p)
+        if o in ('-b', '--batch'):
+            batch_rows = int(p)
+
+    cluster, session = connect(host)
+    session.execute(keyspace_create.format(keyspace))
+    session.set_keyspace(keyspace)
+    create_tables(session, tables)
+    load_all(session, files or 'event_datafile_new.csv', tables, concurrency, batch_rows)
+    session.shutdown()
+    cluster.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import os
+import csv
+import sys
+import heapq
+import getopt
+import tempfile
+from time import time
+from datetime import datetime
+from multiprocessing import Pool
+
+
+"""The script "consolidate_events.py" replaces the pre-processing part of the notebook for large inputs:
+- All csv files below the event_data directory are parsed by a pool of worker processes
+- Rows with an empty artist are dropped and the 11 columns of event_datafile_new.csv are selected
+- The rows are distributed over shards by sessionId (the partition key of the query tables) and
+  every shard is written sorted by sessionId and itemInSession
+- A shard is sorted by an external merge sort: runs of at most run_rows rows are sorted and written
+  to disk, then the runs are merged (heapq.merge), so a worker never holds more than one run in memory
+Only one input file per worker and one run per worker are held in memory at a time
+"""
+
+header = ['artist', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+          'level', 'location', 'sessionId', 'song', 'userId']
+# Positions of the header columns in the original event files
+source_columns = (0, 2, 3, 4, 5, 6, 7, 8, 12, 13, 16)
+session_column = header.index('sessionId')
+item_column = header.index('itemInSession')
+
+csv.register_dialect('myDialect', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+
+
+def find_event_files(filepath):
+    """Recursively collects all csv files below filepath, hidden files and directories are skipped
+    Returns a sorted list of file paths"""
+    file_path_list = []
+    for root, dirs, files in os.walk(filepath):
+        # Remove UNIX hidden directories and files
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for file in files:
+            if not file.startswith('.') and file.lower().endswith('.csv'):
+                file_path_list.append(os.path.join(root, file))
+    return sorted(file_path_list)
+
+
+def read_event_file(filepath):
+    """Reads one event csv file, drops rows without artist and selects the output columns
+    Returns a list of rows"""
+    rows = []
+    with open(filepath, 'r', encoding='utf8', newline='') as csvfile:
+        csvreader = csv.reader(csvfile)
+        next(csvreader, None)
+        for line in csvreader:
+            if not line or line[0] == '':
+                continue
+            rows.append([line[i] for i in source_columns])
+    return rows
+
+
+def shard_of(row, shards):
+    """Returns the shard number of a row, all rows of a session end up in the same shard"""
+    return int(float(row[session_column])) % shards
+
+
+def sort_key(row):
+    """Sorts rows by partition (sessionId) and clustering column (itemInSession)"""
+    return int(float(row[session_column])), int(float(row[item_column]))
+
+
+def write_run(rows, run_file):
+    """Sorts rows and writes them into a run file of the external merge sort
+    Returns the run file name"""
+    rows.sort(key=sort_key)
+    with open(run_file, 'w', encoding='utf8', newline='') as f:
+        csv.writer(f).writerows(rows)
+    return run_file
+
+
+def sort_shard(task):
+    """Sorts one unsorted shard file and writes the final output file with header
+    A shard with more than run_rows rows is split into sorted runs which are merged into the output
+    Returns output file name and number of rows"""
+    shard_file, output_file, run_rows = task
+    runs, rows, count = [], [], 0
+    with open(shard_file, 'r', encoding='utf8', newline='') as f:
+        for row in csv.reader(f):
+            rows.append(row)
+            count += 1
+            if len(rows) >= run_rows:
+                runs.append(write_run(rows, '{}.run-{:04d}'.format(shard_file, len(runs))))
+                rows = []
+    os.remove(shard_file)
+    with open(output_file, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, dialect='myDialect')
+        writer.writerow(header)
+        if not runs:
+            rows.sort(key=sort_key)
+            writer.writerows(rows)
+            return output_file, count
+        if rows:
+            runs.append(write_run(rows, '{}.run-{:04d}'.format(shard_file, len(runs))))
+        handles = [open(r, 'r', encoding='utf8', newline='') for r in runs]
+        try:
+            writer.writerows(heapq.merge(*[csv.reader(h) for h in handles], key=sort_key))
+        finally:
+            for h, r in zip(handles, runs):
+                h.close()
+                os.remove(r)
+    return output_file, count
+
+
+def output_files(output_dir, shards):
+    """Returns the output file names, a single shard keeps the name of the notebook output"""
+    if shards == 1:
+        return [os.path.join(output_dir, 'event_datafile_new.csv')]
+    return [os.path.join(output_dir, 'event_datafile_new-{:04d}.csv'.format(i)) for i in range(shards)]
+
+
+def consolidate(input_dir, output_dir='.', shards=1, workers=None, run_rows=1000000):
+    """Streams all event files through a process pool into sorted output shards,
+    every shard is sorted in runs of at most run_rows rows
+    Returns the list of written files"""
+    t0 = time()
+    files = find_event_files(input_dir)
+    print(datetime.now(), ': Found {} event files in {}'.format(len(files), input_dir))
+    os.makedirs(output_dir, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(prefix='shards_', dir=output_dir)
+    shard_files = [os.path.join(tmpdir, 'shard-{:04d}.csv'.format(i)) for i in range(shards)]
+    handles = [open(f, 'w', encoding='utf8', newline='') for f in shard_files]
+    writers = [csv.writer(h) for h in handles]
+
+    # Parse in parallel, distribute the rows of every file over the shards as soon as it arrives
+    rows = 0
+    with Pool(workers) as pool:
+        for i, file_rows in enumerate(pool.imap_unordered(read_event_file, files, chunksize=16), 1):
+            for row in file_rows:
+                writers[shard_of(row, shards)].writerow(row)
+            rows += len(file_rows)
+            if i % 1000 == 0 or i == len(files):
+                print(datetime.now(), ': {}/{} files read, {} rows'.format(i, len(files), rows))
+        for h in handles:
+            h.close()
+        # Sort every shard on its own, so only one run per worker is in memory
+        tasks = [(f, o, run_rows) for f, o in zip(shard_files, output_files(output_dir, shards))]
+        results = pool.map(sort_shard, tasks)
+    os.rmdir(tmpdir)
+    print(datetime.now(), ': Wrote {} rows into {} files in {:.1f}s'.format(rows, len(results), time() - t0))
+    return [f for f, n in results]
+
+
+def main(argv=None):
+    """Command line options:
+    -i DIR / --input DIR : directory with the event csv files, default "event_data"
+    -o DIR / --output DIR : output directory, default current directory
+    -n N / --shards N : number of output files, default 1 (event_datafile_new.csv)
+    -w N / --workers N : worker processes, default number of cores
+    -r N / --run-rows N : rows sorted in memory at a time per worker, default 1000000"""
+    opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 'i:o:n:w:r:',
+                               ['input=', 'output=', 'shards=', 'workers=', 'run-rows='])
+    input_dir, output_dir, shards, workers, run_rows = 'event_data', '.', 1, None, 1000000
+    for o, p in opts:
+        if o in ('-i', '--input'):
+            input_dir = p
+        if o in ('-o', '--output'):
+            output_dir = p
+        if o in ('-n', '--shards'):
+            shards = int(p)
+        if o in ('-w', '--workers'):
+            workers = int(p)
+        if o in ('-r', '--run-rows'):
+            run_rows = int(p)
+    consolidate(input_dir, output_dir, shards, workers, run_rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import threading
+from time import monotonic
+from collections import OrderedDict
+
+
+"""The module "query_service.py" exposes the three access patterns of the notebook as prepared,
+parameterized calls for the dashboard:
+- song_by_session(session_id, item_in_session): artist, song title and length of one item in a session
+- songs_by_user_session(session_id, user_id): artist, song and user name of a user session ordered by item
+- listeners_by_song(song_title): first and last names of all users who listened to a song
+Every call has an async variant returning the driver's ResponseFuture and a paging variant "pages"
+which yields one page of fetch_size rows at a time. Results of the synchronous calls can be kept in a
+short-lived LRU cache.
+"""
+
+queries = {
+    'song_by_session': "SELECT artist, song_title, song_length FROM artistTitle_by_sessiondata WHERE sessionId = ? AND itemInSession = ?",
+    'songs_by_user_session': "SELECT artist, song_title, user_first, user_last FROM artistTitle_by_userSession WHERE sessionId = ? AND userId = ? ORDER BY itemInSessions",
+    # userId is the clustering column, so every user appears only once per song without GROUP BY
+    'listeners_by_song': "SELECT user_first, user_last FROM user_by_title WHERE song_title = ?",
+}
+
+
+class TTLCache:
+    """Least recently used cache with at most maxsize entries which expire ttl seconds after they were stored"""
+
+    def __init__(self, maxsize=1024, ttl=5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached value or None if the key is unknown or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """Stores a value, the least recently used entry is evicted when the cache is full"""
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class QueryService:
+    """Prepares the queries of the three query tables once per session
+    fetch_size limits the rows per page, so large partitions are not pulled into memory at once
+    With cache_ttl (seconds) the results of the synchronous calls are cached for that time"""
+
+    def __init__(self, session, fetch_size=1000, cache_ttl=None, cache_size=1024):
+        self.session = session
+        self.fetch_size = fetch_size
+        self.statements = {}
+        for name, cql in queries.items():
+            statement = session.prepare(cql)
+            statement.fetch_size = fetch_size
+            self.statements[name] = statement
+        self.cache = TTLCache(cache_size, cache_ttl) if cache_ttl else None
+
+    def execute(self, name, params):
+        """Runs a prepared query and returns all rows as a list (all pages are fetched)"""
+        key = (name,) + tuple(params)
+        if self.cache is not None:
+            rows = self.cache.get(key)
+            if rows is not None:
+                return rows
+        rows = list(self.session.execute(self.statements[name], params))
+        if self.cache is not None:
+            self.cache.put(key, rows)
+        return rows
+
+    def execute_async(self, name, params):
+        """Runs a prepared query without waiting, returns the ResponseFuture of the driver
+        Use future.result() to get the first page or add callbacks"""
+        return self.session.execute_async(self.statements[name], params)
+
+    def pages(self, name, params):
+        """Runs a prepared query and yields one list of at most fetch_size rows per page,
+        the next page is requested only when the previous one was consumed"""
+        result = self.session.execute(self.statements[name], params)
+        while True:
+            yield list(result.current_rows)
+            if not result.has_more_pages:
+                break
+            result.fetch_next_page()
+
+    def song_by_session(self, session_id, item_in_session):
+        """Artist, song title and song length of the item played in a session"""
+        return self.execute('song_by_session', (session_id, item_in_session))
+
+    def song_by_session_async(self, session_id, item_in_session):
+        return self.execute_async('song_by_session', (session_id, item_in_session))
+
+    def songs_by_user_session(self, session_id, user_id):
+        """Artist, song title and user name of all songs of a user session ordered by itemInSession"""
+        return self.execute('songs_by_user_session', (session_id, user_id))
+
+    def songs_by_user_session_async(self, session_id, user_id):
+        return self.execute_async('songs_by_user_session', (session_id, user_id))
+
+    def listeners_by_song(self, song_title):
+        """First and last name of all users who listened to the song"""
+        return self.execute('listeners_by_song', (song_title,))
+
+    def listeners_by_song_async(self, song_title):
+        return self.execute_async('listeners_by_song', (song_title,))
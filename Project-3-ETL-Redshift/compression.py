@@ -0,0 +1,107 @@
+import re
+from datetime import datetime
+from sql_queries import analyze_compression, table_encoding_select, table_size_select, analytics_table_creates
+from dist_advisor import column_list, deep_copy
+from telemetry import step
+
+
+"""The module "compression.py" applies column compression encodings to the analytics tables after a load:
+- ANALYZE COMPRESSION recommends an encoding per column based on a sample of comprows rows
+- The recommendation is adjusted: AZ64 for integer, decimal, date and timestamp columns, ZSTD for text,
+  BYTEDICT for low cardinality columns (level, gender) and RAW for the first sort key column
+  (compressing it would make zone maps less selective)
+- Tables whose encodings differ are rebuilt with a deep copy (see "dist_advisor.py")
+- Every table is measured as a step of "telemetry.py", the saved MB of a rebuild are stored with it
+"""
+
+az64_types = ('smallint', 'integer', 'bigint', 'numeric', 'date', 'timestamp')
+low_cardinality = ('level', 'gender')
+
+
+def first_sortkey(create):
+    """ Finds the first sort key column of a CREATE TABLE statement
+        Returns: column name or None"""
+    match = re.search(r'sortkey\s*\(\s*([a-z_][a-z0-9_]*)', create, re.I)
+    return match.group(1).lower() if match else None
+
+
+def choose_encoding(column, data_type, recommended, sortkey):
+    """ Returns the encoding of one column, see the module description for the rules"""
+    data_type = data_type.lower()
+    if column == sortkey:
+        return 'raw'
+    if column in low_cardinality:
+        return 'bytedict'
+    if data_type.startswith(az64_types):
+        return 'az64'
+    if data_type.startswith(('character', 'varchar', 'char')):
+        return recommended if recommended in ('bytedict', 'runlength', 'text255', 'text32k') else 'zstd'
+    return recommended or 'zstd'
+
+
+def recommend_encodings(cur, table, comprows=100000):
+    """ Runs ANALYZE COMPRESSION on a sample of the table and adjusts the result
+        Returns: dictionary column -> encoding, dictionary column -> current encoding"""
+    cur.execute(analyze_compression.format(table, comprows))
+    recommended = {row[1].lower(): row[2].lower() for row in cur.fetchall()}
+    cur.execute(table_encoding_select, (table,))
+    columns = cur.fetchall()
+    sortkey = first_sortkey(analytics_table_creates[table])
+    encodings = {c.lower(): choose_encoding(c.lower(), t, recommended.get(c.lower()), sortkey) for c, t, e in columns}
+    # pg_table_def reports RAW columns as encoding "none"
+    current = {c.lower(): 'raw' if (e or 'none').lower() == 'none' else e.lower() for c, t, e in columns}
+    return encodings, current
+
+
+def encoded_ddl(create, encodings):
+    """ Adds an ENCODE clause to every column definition of a CREATE TABLE statement
+        Returns: CREATE TABLE statement"""
+    start, end = column_list(create)
+    parts, depth, part = [], 0, ''
+    for char in create[start:end]:
+        depth += char == '('
+        depth -= char == ')'
+        if char == ',' and depth == 0:
+            parts.append(part)
+            part = ''
+        else:
+            part += char
+    parts.append(part)
+    for i, p in enumerate(parts):
+        words = p.split()
+        if words and words[0].lower() in encodings:
+            # Keep the line break before the closing bracket of the column list
+            parts[i] = p.rstrip() + ' ENCODE ' + encodings[words[0].lower()] + p[len(p.rstrip()):]
+    return create[:start] + ','.join(parts) + create[end:]
+
+
+def table_size(cur, table):
+    """ Reads the size of a table in MB (1 MB blocks) from svv_table_info
+        Returns: size in MB"""
+    cur.execute(table_size_select, (table,))
+    row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+def compress_tables(cur, conn, tables=None, comprows=100000):
+    """ Analyzes the compression of the analytics tables (or the given tables) and rebuilds every
+        table whose encodings differ from the recommendation, every table is measured as a step of
+        "telemetry.py", the saved MB are stored in column saved_mb of the dashboard table
+        Returns: dictionary table -> (size before, size after) in MB"""
+    results = {}
+    for table in tables or analytics_table_creates:
+        with step('Compress {}'.format(table), cur) as s:
+            encodings, current = recommend_encodings(cur, table, comprows)
+            before = table_size(cur, table)
+            if encodings == current:
+                print(datetime.now(), ': Encodings of table ', table, ' are up to date')
+                continue
+            print(datetime.now(), ': Encodings of table {}: {}'.format(table, encodings))
+            if not deep_copy(cur, conn, table, encoded_ddl(analytics_table_creates[table], encodings)):
+                continue
+            after = table_size(cur, table)
+            results[table] = (before, after)
+            s.saved_mb = before - after
+        print(datetime.now(), ': Table {} needs {} MB instead of {} MB, saved {} MB'.format(table, after, before, before - after))
+    conn.commit()
+    return results
@@ -7,7 +7,7 @@ import logging
 import pandas as pd
 from datetime import datetime
 from botocore.exceptions import ClientError
-from sql_queries import create_table_queries, drop_table_queries, dist_schema, search_path, create_redshift_tables
+from sql_queries import create_table_queries, drop_table_queries, dist_schema, search_path
 
 
 """The scrip "create_tables.py" has the following tasks:
@@ -86,7 +86,7 @@ def drop_all_tables(cur, conn):
 def create_all_tables(cur, conn):
     # Connect to DB and define new table setup
     # Returns: Nothing
-    for query in create_redshift_tables:
+    for query in create_table_queries:
         cur.execute(query)
         conn.commit()
   
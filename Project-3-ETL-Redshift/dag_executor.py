@@ -0,0 +1,89 @@
+from time import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+"""The module "dag_executor.py" runs groups of SQL statements as nodes of a dependency graph:
+- A graph maps a node name to its list of queries and the names of the nodes it depends on
+  (see "insert_table_graph" in "sql_queries.py")
+- Every node whose dependencies are finished is started in a thread with its own connection
+  from a psycopg2 connection pool, so independent inserts run at the same time on the cluster
+- A node with a failed query counts as failed, nodes depending on it are skipped
+- The runtime of every node is returned
+Nothing in here is Redshift specific, the executor works against a local Postgres as well
+"""
+
+
+def run_node(pool, name, queries):
+    """ Takes a connection from the pool and runs the queries of one node in autocommit mode,
+        a failed query is logged and rolled back, the remaining queries still run
+        Returns: runtime in seconds, number of failed queries"""
+    conn = pool.getconn()
+    failed = 0
+    try:
+        conn.set_session(autocommit=True)
+        cur = conn.cursor()
+        t0 = time()
+        print(datetime.now(), ': Starting node ', name)
+        for query in queries:
+            try:
+                cur.execute(query)
+            except Exception as e:
+                print(datetime.now(), ': Node ', name, ' failed to execute query ', query, ' raising: ', e)
+                cur.execute('rollback')
+                failed += 1
+        runtime = time() - t0
+        print(datetime.now(), ': Finished node {} in {:.1f}s'.format(name, runtime))
+        cur.close()
+    finally:
+        pool.putconn(conn)
+    return runtime, failed
+
+
+def check_graph(graph):
+    """ Checks that all dependencies exist and that the graph has no cycle
+        Returns: Nothing, raises ValueError"""
+    for name, (queries, depends) in graph.items():
+        for d in depends:
+            if d not in graph:
+                raise ValueError('Node {} depends on unknown node {}'.format(name, d))
+    done, pending = set(), dict(graph)
+    while pending:
+        ready = [n for n, (q, depends) in pending.items() if set(depends) <= done]
+        if not ready:
+            raise ValueError('Cycle between nodes {}'.format(sorted(pending)))
+        for n in ready:
+            done.add(n)
+            del pending[n]
+
+
+def run_graph(pool, graph, workers=4):
+    """ Runs all nodes of the graph, a node starts as soon as all nodes it depends on are finished
+        At most "workers" nodes run at the same time, the pool needs as many connections
+        A node with a failed query fails, the nodes depending on it (directly or not) are skipped
+        Returns: dictionary with the runtime in seconds per node, list of failed and skipped nodes"""
+    check_graph(graph)
+    runtimes, failed = {}, []
+    pending = dict(graph)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            blocked = [n for n, (q, depends) in pending.items() if any(d in failed for d in depends)]
+            for name in blocked:
+                print(datetime.now(), ': Skipping node ', name, ', a node it depends on failed')
+                del pending[name]
+                failed.append(name)
+            ready = [n for n, (q, depends) in pending.items() if all(d in runtimes and d not in failed for d in depends)]
+            for name in ready:
+                queries, depends = pending.pop(name)
+                running[executor.submit(run_node, pool, name, queries)] = name
+            if not running:
+                continue
+            finished, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                runtimes[name], node_failed = future.result()
+                if node_failed:
+                    failed.append(name)
+    return runtimes, failed
+
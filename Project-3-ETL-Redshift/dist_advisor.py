@@ -0,0 +1,268 @@
+import re
+import sys
+import json
+import getopt
+import configparser
+import psycopg2
+import boto3
+from datetime import datetime
+import sql_queries
+
+
+"""The script "dist_advisor.py" recommends distribution and sort keys for the analytics tables:
+- Collects the analytics queries of "sql_queries.py" and the %sql queries of "Dashboard.ipynb"
+- Counts per table which columns are used in joins and in filters, group by and order by clauses
+- Small dimension tables get DISTSTYLE ALL (a copy on every node, joins never redistribute them),
+  the fact table gets its most joined column as DISTKEY and a compound sort key starting with its
+  timestamp, dimensions are sorted by their join column
+- Prints the DDL of every table and with option "-a" rebuilds the tables by a deep copy
+  (rename, create with the new DDL, insert from the old table, drop the old table) on the Redshift
+  cluster of section DWH in dwh.cfg
+"""
+
+keywords = {'on', 'where', 'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'group', 'order',
+            'limit', 'using', 'select', 'set', 'and', 'or', 'having', 'union'}
+
+deep_copy_rename = ("""alter table {0} rename to {0}_old;""")
+deep_copy_insert = ("""insert into {0} ({1}) select {1} from {0}_old;""")
+deep_copy_drop = ("""drop table {0}_old;""")
+table_rows_select = ("""select "table", tbl_rows from svv_table_info;""")
+
+
+def workload_queries(notebook='Dashboard.ipynb'):
+    """ Collects all SQL select statements of sql_queries.py and the %sql lines of the notebook
+        Returns: list of SQL strings"""
+    queries = [v for k, v in vars(sql_queries).items()
+               if isinstance(v, str) and not k.startswith('_') and 'select' in v.lower()]
+    try:
+        with open(notebook) as f:
+            cells = json.load(f)['cells']
+    except (OSError, ValueError) as e:
+        print(datetime.now(), ': Could not read notebook ', notebook, e)
+        cells = []
+    for cell in cells:
+        if cell['cell_type'] != 'code':
+            continue
+        for line in ''.join(cell['source']).splitlines():
+            if '%sql' in line and 'select' in line.lower():
+                queries.append(line.split('%sql', 1)[1])
+    return queries
+
+
+def table_aliases(query):
+    """ Finds the tables of the from and join clauses and their aliases
+        Returns: dictionary alias (or table name) -> table name"""
+    aliases = {}
+    not_alias = '|'.join(sorted(keywords))
+    pattern = r'\b(?:from|join)\s+([a-z_][a-z0-9_\.]*)(?:\s+(?:as\s+)?(?!(?:{})\b)([a-z_][a-z0-9_]*))?'.format(not_alias)
+    for table, alias in re.findall(pattern, query):
+        table = table.split('.')[-1]
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    return aliases
+
+
+def analyze_workload(queries, tables):
+    """ Counts how often each column of the given tables is used in a join condition and in
+        filters, group by or order by clauses
+        Returns: dictionary table -> {'joins': {column: count}, 'filters': {column: count},
+                 'partners': {table: count}}"""
+    usage = {t: {'joins': {}, 'filters': {}, 'partners': {}} for t in tables}
+
+    def count(table, kind, column):
+        if table in usage:
+            usage[table][kind][column] = usage[table][kind].get(column, 0) + 1
+
+    for query in queries:
+        query = ' '.join(query.lower().split())
+        aliases = table_aliases(query)
+        # Join conditions: a.x = b.y or a.x like b.y, also inside expressions like md5(...)
+        for a1, c1, a2, c2 in re.findall(r'([a-z_][a-z0-9_]*)\.([a-z_][a-z0-9_]*)\s*(?:=|like)\s*([a-z_][a-z0-9_]*)\.([a-z_][a-z0-9_]*)', query):
+            t1, t2 = aliases.get(a1), aliases.get(a2)
+            if t1 and t2 and t1 != t2:
+                count(t1, 'joins', c1)
+                count(t2, 'joins', c2)
+                count(t1, 'partners', t2)
+                count(t2, 'partners', t1)
+        # Filters, group by and order by on qualified columns (or bare columns of a single table query)
+        clauses = re.findall(r'\b(?:where|group by|order by|having)\b(.*?)(?=\b(?:group by|order by|limit|having|union)\b|;|$)', query)
+        tables_used = set(aliases.values())
+        single = tables_used.pop() if len(tables_used) == 1 else None
+        for clause in clauses:
+            for alias, column in re.findall(r'\b([a-z_][a-z0-9_]*)\.([a-z_][a-z0-9_]*)\b(?!\s*(?:=|like)\s*[a-z_]+\.)', clause):
+                if alias in aliases:
+                    count(aliases[alias], 'filters', column)
+            if single:
+                for column in re.findall(r'(?<![\.\w])([a-z_][a-z0-9_]*)\s*(?:=|<|>|between|is|in\b)', clause):
+                    if column not in keywords:
+                        count(single, 'filters', column)
+    return usage
+
+
+def get_table_rows(cur):
+    """ Reads the number of rows per table from svv_table_info
+        Returns: dictionary table -> rows"""
+    cur.execute(table_rows_select)
+    return {table: int(rows) for table, rows in cur.fetchall()}
+
+
+def column_list(create):
+    """ Finds the column list of a CREATE TABLE statement (between the first bracket and its partner)
+        Returns: start and end position of the column list"""
+    start = create.index('(')
+    depth = 0
+    for pos in range(start, len(create)):
+        depth += create[pos] == '('
+        depth -= create[pos] == ')'
+        if depth == 0:
+            return start + 1, pos
+    raise ValueError('Unbalanced brackets in {}'.format(create))
+
+
+def ddl_columns(create):
+    """ Parses the column names of a CREATE TABLE statement, identity columns are skipped
+        Returns: list of column names"""
+    start, end = column_list(create)
+    columns, depth, part = [], 0, ''
+    for char in create[start:end] + ',':
+        depth += char == '('
+        depth -= char == ')'
+        if char == ',' and depth == 0:
+            words = part.split()
+            if words and words[0].lower() not in ('primary', 'foreign', 'unique', 'constraint') \
+                    and 'identity' not in part.lower():
+                columns.append(words[0].strip('"'))
+            part = ''
+        else:
+            part += char
+    return columns
+
+
+def references(table, creates):
+    """ Counts the columns of a table which are the primary key of another table
+        Returns: number of references"""
+    keys = set()
+    for other, create in creates.items():
+        if other != table:
+            keys.update(k.strip().lower() for k in re.findall(r'primary key\s*\(([^)]*)\)', create, re.I))
+    return len([c for c in ddl_columns(creates[table]) if c.lower() in keys])
+
+
+def recommend(usage, creates, table_rows=None, small_rows=5000000):
+    """ Recommends a layout per table:
+        - The fact table is the table with the most rows (or with the most references to the
+          primary keys of the other tables if the row counts are unknown), it is distributed
+          on its most joined column
+        - All other tables with at most small_rows rows get DISTSTYLE ALL
+        - Sort keys: timestamp column of the fact table first, then its distkey, dimensions
+          are sorted by their most joined (or filtered) column
+        Returns: dictionary table -> {'diststyle', 'distkey', 'sortkey'}"""
+    table_rows = table_rows or {}
+    if table_rows:
+        fact = max(usage, key=lambda t: table_rows.get(t, 0))
+    else:
+        fact = max(usage, key=lambda t: references(t, creates))
+    advice = {}
+    for table, u in usage.items():
+        columns = ddl_columns(creates[table])
+        ranked = sorted(u['joins'], key=lambda c: -u['joins'][c]) + sorted(u['filters'], key=lambda c: -u['filters'][c])
+        ranked = [c for c in ranked if c in columns] or columns[:1]
+        if table == fact:
+            timestamps = [c for c in columns if re.search(r'\b{}\s+timestamp'.format(c), creates[table], re.I)]
+            distkey = ranked[0]
+            advice[table] = {'diststyle': 'key', 'distkey': distkey,
+                             'sortkey': timestamps[:1] + [distkey]}
+        elif table_rows.get(table, 0) <= small_rows:
+            advice[table] = {'diststyle': 'all', 'distkey': None, 'sortkey': ranked[:1]}
+        else:
+            advice[table] = {'diststyle': 'even', 'distkey': None, 'sortkey': ranked[:1]}
+    return advice
+
+
+def table_ddl(create, advice):
+    """ Rewrites a CREATE TABLE statement: table attributes and inline distkey/sortkey column
+        attributes are removed and the recommended table attributes are appended
+        Returns: CREATE TABLE statement"""
+    start, end = column_list(create)
+    ddl = re.sub(r'\s+(?:distkey|sortkey)\b', '', create[:end + 1], flags=re.I)
+    ddl += '\n    diststyle {}'.format(advice['diststyle'])
+    if advice['distkey']:
+        ddl += ' distkey ({})'.format(advice['distkey'])
+    if advice['sortkey']:
+        ddl += '\n    compound sortkey ({})'.format(', '.join(advice['sortkey']))
+    return ddl + ';'
+
+
+def deep_copy(cur, conn, table, ddl):
+    """ Rebuilds a table with new DDL inside one transaction: the table is renamed, created again,
+        filled from the old table and the old table is dropped
+        Identity columns are not copied, their values are generated again
+        Returns: True if the table was rebuilt"""
+    columns = ', '.join(ddl_columns(ddl))
+    print(datetime.now(), ': Deep copy of table ', table)
+    cur.execute('begin;')
+    try:
+        cur.execute(deep_copy_rename.format(table))
+        cur.execute(ddl)
+        cur.execute(deep_copy_insert.format(table, columns))
+        cur.execute(deep_copy_drop.format(table))
+        cur.execute('end;')
+        return True
+    except Exception as e:
+        print(datetime.now(), ': FAILED deep copy of table ', table, ' raising: ', e)
+        cur.execute('rollback;')
+        return False
+
+
+def connect_dwh(schema='public', config_file='dwh.cfg'):
+    """ Connects to the Redshift cluster of section DWH in the config file like "etl.py" does:
+        the endpoint is read from the cluster description of the Redshift API
+        Returns: connection in autocommit mode, cursor with the search_path set to schema"""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    redshift = boto3.client('redshift', region_name='us-west-2', aws_access_key_id=config.get('AWS', 'KEY'),
+                            aws_secret_access_key=config.get('AWS', 'SECRET'))
+    props = redshift.describe_clusters(ClusterIdentifier=config.get('DWH', 'DWH_CLUSTER_IDENTIFIER'))['Clusters'][0]
+    conn = psycopg2.connect('host={} dbname={} user={} password={} port={}'.format(
+        props['Endpoint']['Address'], *[config.get('DWH', k) for k in ('DWH_DB', 'DWH_DB_USER', 'DWH_DB_PASSWORD', 'DWH_PORT')]))
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute(sql_queries.search_path.format(schema))
+    print(datetime.now(), ': Connected to {} on {}'.format(props['ClusterIdentifier'], props['Endpoint']['Address']))
+    return conn, cur
+
+
+def main(argv=None):
+    """ Prints the recommended DDL of the analytics tables
+        Command line options:
+            -a / --apply : rebuild the tables on the Redshift cluster of section DWH in dwh.cfg
+            -s NAME / --schema NAME : schema of the tables, default public
+            -n FILE / --notebook FILE : notebook with %sql queries, default Dashboard.ipynb"""
+    opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 'as:n:', ['apply', 'schema=', 'notebook='])
+    apply, schema, notebook = False, 'public', 'Dashboard.ipynb'
+    for o, p in opts:
+        if o in ('-a', '--apply'):
+            apply = True
+        if o in ('-s', '--schema'):
+            schema = p
+        if o in ('-n', '--notebook'):
+            notebook = p
+    creates = sql_queries.analytics_table_creates
+    usage = analyze_workload(workload_queries(notebook), list(creates))
+    cur = None
+    if apply:
+        conn, cur = connect_dwh(schema)
+    advice = recommend(usage, creates, get_table_rows(cur) if cur else None)
+    for table, a in advice.items():
+        print(datetime.now(), ': {} joins {} filters {} -> {}'.format(table, usage[table]['joins'], usage[table]['filters'], a))
+        ddl = table_ddl(creates[table], a)
+        print(ddl)
+        if cur:
+            deep_copy(cur, conn, table, ddl)
+    if cur:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,21 @@
 import configparser
 import psycopg2
+import psycopg2.pool
 import botocore
 import boto3
 import pandas as pd
 import json
 import sys
 import socket
-from time import time
+import getopt
 from datetime import datetime
 from botocore.exceptions import ClientError
 from sql_queries import *
+from dag_executor import run_graph
+from telemetry import step, add_step, copy_count, flush, label_queries, new_label
+from compression import compress_tables
+from maintenance import run_maintenance
+from s3_manifest import create_manifest, get_slice_count, list_files, write_manifest
 
 '''The scrip 'etl.py' has the following tasks:
 - Read configuration data for Redshift database and S3 storage
@@ -23,6 +29,9 @@ from sql_queries import *
 - Closes db connection and exits
 '''
 
+# Schema of the tables, like in "create_tables.py" the default, so the connections of the pool use it too
+schema = 'public'
+
 
 def import_config_file(*new_arn):
     """ Reads configuration file dwh.cfg and defines a set of global variables
@@ -153,10 +162,12 @@ def search_bucket(s3handler, prefix, amount=10):
     return filelist
 
 
-def load_staging_tables(cur, conn, arn, logs, songs):
+def load_staging_tables(cur, conn, arn, logs, songs, s3client=None, manifest_root=None):
     """ Takes a list of json files provided in filepath and uses the Redshift Copy command
         to insert the data into staging_tables. Only required if the users wants to process
         a specific number of files instead of all files.
+        If manifest_root (an s3:// url of a writable bucket) is given, the prefixes are listed
+        in parallel and loaded from manifests instead (see "s3_manifest.py")
         Returns: Nothing
         """
     # Check if entries in staging tables already exists and if not then create all new tables
@@ -171,37 +182,166 @@ def load_staging_tables(cur, conn, arn, logs, songs):
         print(datetime.now(), ': Found {0} entries in database, database not empty'.format(entries))
         print(datetime.now(), ': Please run script "create_tables.py" to initiate staging tables')
     else:
-        t0 = time()
         print(datetime.now(), ': Resetting tables')
-        cur.execute(dist_schema)
-        cur.execute(search_path)
+        cur.execute(dist_schema.format(schema))
+        cur.execute(search_path.format(schema))
         drop_all_tables(cur, conn)
         create_all_tables(cur, conn)
+        songs_copy, events_copy = staging_songs_copy, staging_events_copy
+        if manifest_root:
+            with step('Building manifests', cur):
+                slices = get_slice_count(cur)
+                print(datetime.now(), ': Building manifests for {} slices'.format(slices))
+                songs, song_files = create_manifest(s3client, songs, manifest_root + 'songs.manifest', slices)
+                logs, log_files = create_manifest(s3client, logs, manifest_root + 'logs.manifest', slices)
+                songs_copy, events_copy = staging_songs_copy_manifest, staging_events_copy_manifest
         print(datetime.now(), ': Starting copy of songs using prefix ', songs)
-        cur.execute(staging_songs_copy.format(songs, arn))
-        t1 = time()
-        runtime = t1 - t0
-        cur.execute('insert into dashboard (step, runtime) values (\'Loading songs from S3\', {})'.format(runtime))
+        with step('Loading songs from S3', cur) as s:
+            cur.execute(songs_copy.format(songs, arn))
+            s.rows = copy_count(cur)
         print(datetime.now(), ': Starting copy of logfiles using prefix ', logs)
-        cur.execute(staging_events_copy.format(logs, arn))
+        with step('Loading events from S3', cur) as s:
+            cur.execute(events_copy.format(logs, arn))
+            s.rows = copy_count(cur)
         print(datetime.now(), ': Done')
-        t2 = time()
-        runtime = t2 - t1
-        cur.execute('insert into dashboard (step, runtime) values (\'Loading events from S3\', {})'.format(runtime))
-        conn.commit()
-        print(datetime.now(), ': Running vacuum and analyze')
-        cur.execute('vacuum')
-        cur.execute('analyze')
-        t3 = time()
-        runtime = t3 - t2
-        cur.execute('insert into dashboard (step, runtime) values (\'Vacuum staging\', {})'.format(runtime))
         conn.commit()
+        if manifest_root:
+            record_load_history(cur, conn, song_files + log_files)
+        print(datetime.now(), ': Running vacuum and analyze where needed')
+        run_maintenance(cur, conn, staging_tables)
     print(datetime.now(), ': Loading done')
 
 
-def fill_analytics(cur, conn):
+def record_load_history(cur, conn, files):
+    """ Writes the url, ETag and size of the loaded S3 objects into load_history,
+        500 objects per insert statement
+        Returns: Nothing
+        """
+    for i in range(0, len(files), 500):
+        values = ', '.join(cur.mogrify('(%s, %s, %s, getdate())', (f['url'], f['etag'], f['size'])).decode('utf-8')
+                           for f in files[i:i + 500])
+        cur.execute(load_history_insert.format(values))
+    conn.commit()
+    print(datetime.now(), ': Recorded ', len(files), ' files in load history')
+
+
+def load_staging_incremental(cur, conn, arn, logs, songs, s3client, manifest_root):
+    """ Lists the song and log prefixes and copies only the objects whose url and ETag are not
+        in load_history yet, using manifests below manifest_root (an s3:// url)
+        Both staging tables are emptied first and hold only the new files afterwards, so the
+        merge reads the delta only (song_lookup keeps the songs of earlier runs)
+        Returns: list of the copied files or None if the load was refused
+        """
+    try:
+        cur.execute('select count (*) from staging_events')
+        entries = cur.fetchone()[0]
+        cur.execute('select count (*) from staging_songs')
+        entries = entries + cur.fetchone()[0]
+    except:
+        entries = None
+    if entries is None:
+        print(datetime.now(), ': Staging tables not found, creating all tables')
+        drop_all_tables(cur, conn)
+        create_all_tables(cur, conn)
+    cur.execute(load_history_create)
+    cur.execute(load_history_select)
+    loaded = set(cur.fetchall())
+    if entries and not loaded:
+        print(datetime.now(), ': Found {0} entries in staging tables but no load history'.format(entries))
+        print(datetime.now(), ': Please run "create_tables.py" or a full load with a manifest (option -m) first')
+        return None
+    with step('Listing new files', cur):
+        slices = get_slice_count(cur)
+        new_songs = [f for f in list_files(s3client, songs) if (f['url'], f['etag']) not in loaded]
+        new_logs = [f for f in list_files(s3client, logs) if (f['url'], f['etag']) not in loaded]
+    print(datetime.now(), ': Found ', len(new_songs), ' new song files and ', len(new_logs), ' new log files')
+    cur.execute(staging_events_truncate)
+    cur.execute(staging_songs_truncate)
+    with step('Loading new songs from S3', cur) as s:
+        if new_songs:
+            manifest = write_manifest(s3client, new_songs, manifest_root + 'songs-delta.manifest', slices)
+            cur.execute(staging_songs_copy_manifest.format(manifest, arn))
+            s.rows = copy_count(cur)
+    with step('Loading new events from S3', cur) as s:
+        if new_logs:
+            manifest = write_manifest(s3client, new_logs, manifest_root + 'logs-delta.manifest', slices)
+            cur.execute(staging_events_copy_manifest.format(manifest, arn))
+            s.rows = copy_count(cur)
+    conn.commit()
+    return new_songs + new_logs
+
+
+def insert_analytics(cur, conn, queries):
+    """ Runs the insert queries of the analytics tables, the dimension tables are de-duplicated
+        while inserting (see "user_table_upsert" in sql_queries.py), so no clean-up is needed
+        A failed query is rolled back and raised again, the following queries (songplays is last)
+        are not run
+        Returns: Nothing
+        """
+    for query in queries:
+        try:
+            cur.execute(query)
+        except Exception as e:
+            print(datetime.now(), ': Failed to execute query ', query, ' raising: ', e)
+            # Leave a failed upsert transaction before giving up
+            cur.execute('rollback')
+            raise
+    conn.commit()
+
+
+def populate_analytics(cur, conn, queries, graph, pool=None, workers=4):
+    """ Fills the analytics tables, one query after the other over conn or, if a connection
+        pool is given, as dependency graph with up to "workers" nodes in parallel, every node
+        is measured as step "Insert <node>" in its own query group (see "telemetry.py")
+        Raises RuntimeError if a node failed, its dependent nodes (songplays) are not run
+        Returns: Nothing
+        """
+    if pool is None:
+        insert_analytics(cur, conn, queries)
+        return
+    labels = {name: new_label() for name in graph}
+    graph = {name: (label_queries(queries, labels[name]), depends) for name, (queries, depends) in graph.items()}
+    runtimes, failed = run_graph(pool, graph, workers)
+    for name, runtime in runtimes.items():
+        add_step('Insert ' + name, runtime, labels[name]).failed = name in failed
+    if failed:
+        raise RuntimeError('Failed or skipped nodes while filling analytics tables: {}'.format(', '.join(failed)))
+
+
+def report_song_matches(cur):
+    """ Counts the NextSong events in staging_events and how many of them found a song in
+        song_lookup, to compare the match rate between loads
+        Returns: number of NextSong events, number of matched events"""
+    cur.execute(song_match_count)
+    events, matched = cur.fetchone()
+    events, matched = int(events or 0), int(matched or 0)
+    rate = 100.0 * matched / events if events else 0.0
+    print(datetime.now(), ': Matched {} of {} NextSong events to songs ({:.2f}%)'.format(matched, events, rate))
+    return events, matched
+
+
+def merge_analytics(cur, conn, files, pool=None, workers=4):
+    """ Merges the new rows of the staging tables into the analytics tables: users of new events
+        and songs and artists of new song files are replaced, new song keys are added to song_lookup,
+        timestamps are only added if unknown, events not yet in songplays are added. The copied files are recorded in load_history afterwards, a failed
+        merge raises before that, so the next run copies the files again
+        With a connection pool the tables are merged in parallel (see "populate_analytics")
+        Returns: Nothing
+        """
+    print(datetime.now(), ': Merging delta into analytics tables')
+    with step('Merge delta', cur):
+        populate_analytics(cur, conn, merge_table_queries, merge_table_graph, pool, workers)
+        report_song_matches(cur)
+    conn.commit()
+    record_load_history(cur, conn, files)
+    # The delta adds unsorted rows and replaces users, maintain only the tables that need it
+    run_maintenance(cur, conn, analytics_tables + staging_tables)
+
+
+def fill_analytics(cur, conn, pool=None, workers=4):
     """ Reads staging tables for songs and events and copies relevant fields
         into analytics tables.
+        With a connection pool the tables are filled in parallel (see "populate_analytics")
         Returns: Nothing
         """
     # First check if data is already there, if so then remove it
@@ -214,38 +354,12 @@ def fill_analytics(cur, conn):
             cur.execute(dropstm)
             # Note: create statements are included in the reset_analytics_tables list
     print(datetime.now(), ': Filling analytics tables')
-    t0 = time()
-    for query in insert_table_queries:
-        try:
-            cur.execute(query)
-        except Exception as e:
-            print(datetime.now(), ': Failed to execute query ', query, ' raising: ', e)
-    conn.commit()
-    t1 = time()
-    runtime = t1 - t0
-    cur.execute('insert into dashboard (step, runtime) values (\'Insert from staging\', {})'.format(runtime))
-    # Remove duplicates
-    candidates = {'songs': 'song_id', 'users': 'user_id', 'artists': 'artist_id'}
-    for table, key in candidates.items():
-        cur.execute('select count(*) from {}'.format(table))
-        before = cur.fetchone()
-        for query in remove_duplicates:
-            cur.execute(query.format(table, key))
-            conn.commit()
-        cur.execute('select count(*) from {}'.format(table))
-        after = cur.fetchone()
-        print(datetime.now(), ': Removed ', (int(before[0]) - int(after[0])), ' duplicate entries from table ', table)
-    t2 = time()
-    runtime = t2 - t1
-    cur.execute('insert into dashboard (step, runtime) values (\'Remove duplicates\', {})'.format(runtime))
-    # Cleanup database
-    print(datetime.now(), ': Running vacuum and analyze')
-    cur.execute('vacuum')
-    cur.execute('analyze')
-    t3 = time()
-    runtime = t3 - t2
-    cur.execute('insert into dashboard (step, runtime) values (\'Vacuum analytics\', {})'.format(runtime))
-    conn.commit()
+    with step('Insert from staging', cur):
+        populate_analytics(cur, conn, insert_table_queries, insert_table_graph, pool, workers)
+        report_song_matches(cur)
+    # Cleanup database, only tables above the thresholds of "maintenance.py"
+    print(datetime.now(), ': Running vacuum and analyze where needed')
+    run_maintenance(cur, conn, analytics_tables)
 
 
 def create_db(handler, roleArn):
@@ -401,8 +515,38 @@ def main(args=None):
             - Using the Redshift instance to read JSON files from S3
             - Inserting JSON content into staging tables
             - Filling analytics tables from staging tables (including removing duplicates
-            - Deleting the instance and removing the IAM role)"""
+            - Deleting the instance and removing the IAM role, unless manifests are used (option -m))
+        Command line options:
+            -m URL / --manifest URL : load the staging tables from manifests written below
+                                      this s3:// url (e.g. s3://my-bucket/manifests/), the
+                                      cluster is kept for the next incremental load
+            -i / --incremental : copy only S3 objects missing in load_history and merge
+                                 the delta into the analytics tables (requires -m), the
+                                 first run on empty tables copies all objects
+            -p N / --parallel N : fill the analytics tables with up to N parallel connections,
+                                  independent tables are loaded at the same time
+            -z / --compress : analyze the compression of the analytics tables after the load
+                              and rebuild them with the recommended encodings
+            -t FILE / --telemetry FILE : append the measured steps as JSON lines to FILE,
+                                         default etl_metrics.jsonl (see "telemetry.py")"""
     print(datetime.now(), ': STARTING SPARKIFYDB DATA LOAD')
+    opts, rest = getopt.getopt(sys.argv[1:] if args is None else args, 'm:ip:zt:',
+                               ['manifest=', 'incremental', 'parallel=', 'compress', 'telemetry='])
+    manifest_root, incremental, workers, compress, metrics_file = None, False, 0, False, 'etl_metrics.jsonl'
+    for o, p in opts:
+        if o in ('-m', '--manifest'):
+            manifest_root = p if p.endswith('/') else p + '/'
+        if o in ('-i', '--incremental'):
+            incremental = True
+        if o in ('-p', '--parallel'):
+            workers = int(p)
+        if o in ('-z', '--compress'):
+            compress = True
+        if o in ('-t', '--telemetry'):
+            metrics_file = p
+    if incremental and not manifest_root:
+        print(datetime.now(), ': Option -i requires a manifest location (option -m)')
+        return
 
     # Import configuration data
     print(datetime.now(), ': Reading config file')
@@ -437,38 +581,72 @@ def main(args=None):
 
     # Connect to database and get a cursor
     try:
-        conn = psycopg2.connect('host={0} dbname={1} user={2} password={3} port={4}'.format(DWH_ENDPOINT, DWH_DB, DWH_DB_USER, DWH_DB_PASSWORD, DWH_PORT))
+        dsn = 'host={0} dbname={1} user={2} password={3} port={4}'.format(DWH_ENDPOINT, DWH_DB, DWH_DB_USER, DWH_DB_PASSWORD, DWH_PORT)
+        conn = psycopg2.connect(dsn)
         conn.set_session(autocommit=True)
         cur = conn.cursor()
         print(datetime.now(), ': SUCCESS connecting {0} on Host {1} via Port {2}'.format(DWH_DB, DWH_ENDPOINT, DWH_PORT))
         retries = 0
+        # Connections for the parallel inserts into the analytics tables
+        pool = psycopg2.pool.ThreadedConnectionPool(1, workers, dsn) if workers > 1 else None
     except Exception as e:
             print(datetime.now(), ': FAILED connecting {0} on Host {1} via Port {2}'.format(DWH_DB, DWH_ENDPOINT, DWH_PORT))
             print(e)
 
+    # Incremental load: copy new S3 objects and merge them into the analytics tables
+    if 'cur' in locals() and incremental:
+        try:
+            s3client = create_client(KEY, SECRET, 's3')
+            new_files = load_staging_incremental(cur, conn, DWH_ROLE_ARN, LOG_DATA, SONG_DATA, s3client, manifest_root)
+            if new_files:
+                merge_analytics(cur, conn, new_files, pool, workers)
+            print_db_info(cur)
+        except Exception as e:
+            print(datetime.now(), ': Failed incremental load ', e)
+
     # Use Redshift copy command to load files into staging tables
-    if 'cur' in locals():
+    if 'cur' in locals() and not incremental:
         try:
             print(datetime.now(), ': Trying to import files using credentials as: ', DWH_ROLE_ARN)
             # Fill staging tables
-            load_staging_tables(cur, conn, DWH_ROLE_ARN, LOG_DATA, SONG_DATA)
+            s3client = create_client(KEY, SECRET, 's3') if manifest_root else None
+            load_staging_tables(cur, conn, DWH_ROLE_ARN, LOG_DATA, SONG_DATA, s3client, manifest_root)
         except Exception as e:
             print(datetime.now(), ': Failed Loading JSON files ', e)
 
     # Fill analytics tables
-    if 'cur' in locals():
+    if 'cur' in locals() and not incremental:
         try:
-            fill_analytics(cur, conn)
+            fill_analytics(cur, conn, pool, workers)
             # Show number of entries in all tables
             print_db_info(cur)
         except Exception as e:
             print(datetime.now(), ': Failed loading data into tables ', e)
 
+    # Apply compression encodings to the analytics tables
+    if 'cur' in locals() and compress:
+        try:
+            compress_tables(cur, conn)
+        except Exception as e:
+            print(datetime.now(), ': Failed compressing tables ', e)
+
+    # Write runtime, rows and bytes scanned of every step to the dashboard table and the metrics file
+    try:
+        flush(cur if 'cur' in locals() else None, locals().get('conn'), metrics_file)
+    except Exception as e:
+        print(datetime.now(), ': Failed writing step metrics ', e)
+
     print(datetime.now(), ': DATA LOAD FINISHED')
 
     # Clean up everything
     if 'conn' in locals():
         conn.close()
+    if locals().get('pool'):
+        pool.closeall()
+    if manifest_root:
+        # The load history only helps if the cluster survives until the next run
+        print(datetime.now(), ': Load with manifests, keeping the Redshift cluster for the next incremental load')
+        return
     redshift_client.delete_cluster( ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,  SkipFinalClusterSnapshot=True)
     revoked_tcp = close_tcp(VPC_ID, MY_IP)
     remove_iam_role(iam_client)
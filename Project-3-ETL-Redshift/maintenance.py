@@ -0,0 +1,103 @@
+import sys
+import getopt
+from datetime import datetime
+from sql_queries import table_maintenance_select, vacuum_sort_only, vacuum_delete_only, vacuum_full, \
+    analyze_predicate_columns, analytics_tables, staging_tables
+from dist_advisor import connect_dwh
+from telemetry import step, flush
+
+
+"""The module "maintenance.py" plans VACUUM and ANALYZE per table instead of running both on the whole database:
+- svv_table_info tells the unsorted percentage, how stale the statistics are (stats_off) and, by comparing
+  tbl_rows with estimated_visible_rows, the percentage of deleted rows that are not reclaimed yet
+- Tables above the thresholds get VACUUM SORT ONLY (unsorted), VACUUM DELETE ONLY (deleted rows) or
+  VACUUM FULL (both), stale statistics get ANALYZE ... PREDICATE COLUMNS
+- Tables below all thresholds are skipped, every action is measured as a step of "telemetry.py"
+"""
+
+unsorted_threshold = 10.0
+stats_threshold = 10.0
+deleted_threshold = 10.0
+
+
+def table_health(cur, tables=None):
+    """ Reads unsorted percentage, stats_off and the percentage of deleted rows per table
+        Returns: dictionary table -> {'unsorted', 'stats_off', 'deleted'} in percent"""
+    cur.execute(table_maintenance_select)
+    health = {}
+    for table, unsorted, stats_off, rows, visible in cur.fetchall():
+        if tables and table not in tables:
+            continue
+        rows, visible = int(rows or 0), int(visible or 0)
+        health[table] = {
+            # Tables without sort key have no unsorted percentage
+            'unsorted': float(unsorted or 0),
+            'stats_off': float(stats_off or 0),
+            'deleted': 100.0 * (rows - visible) / rows if rows and visible < rows else 0.0,
+        }
+    return health
+
+
+def plan_maintenance(health, unsorted_max=unsorted_threshold, stats_max=stats_threshold, deleted_max=deleted_threshold):
+    """ Chooses the maintenance of every table from its health
+        Returns: list of (table, step name, query)"""
+    plan = []
+    for table, h in sorted(health.items()):
+        needs_sort, needs_delete = h['unsorted'] > unsorted_max, h['deleted'] > deleted_max
+        if needs_sort and needs_delete:
+            plan.append((table, 'Vacuum full {}'.format(table), vacuum_full.format(table)))
+        elif needs_sort:
+            plan.append((table, 'Vacuum sort only {}'.format(table), vacuum_sort_only.format(table)))
+        elif needs_delete:
+            plan.append((table, 'Vacuum delete only {}'.format(table), vacuum_delete_only.format(table)))
+        # A vacuum does not update the statistics, so both can be needed
+        if h['stats_off'] > stats_max:
+            plan.append((table, 'Analyze {}'.format(table), analyze_predicate_columns.format(table)))
+    return plan
+
+
+def run_maintenance(cur, conn, tables=None, unsorted_max=unsorted_threshold, stats_max=stats_threshold,
+                    deleted_max=deleted_threshold):
+    """ Plans and runs VACUUM and ANALYZE for the given tables (all tables by default),
+        every action is measured as a step of "telemetry.py"
+        Returns: list of the executed steps with their runtime"""
+    health = table_health(cur, tables)
+    plan = plan_maintenance(health, unsorted_max, stats_max, deleted_max)
+    if not plan:
+        print(datetime.now(), ': No table needs vacuum or analyze')
+    steps = []
+    for table, name, query in plan:
+        print(datetime.now(), ': {} (unsorted {unsorted:.1f}%, stats off {stats_off:.1f}%, deleted {deleted:.1f}%)'.format(name, **health[table]))
+        with step(name, cur) as s:
+            cur.execute(query)
+        steps.append((name, s.runtime))
+    conn.commit()
+    return steps
+
+
+def main(argv=None):
+    """ Runs the maintenance on the Redshift cluster of section DWH in dwh.cfg
+        Command line options:
+            -s NAME / --schema NAME : schema of the tables, default public
+            -u PCT / --unsorted PCT : vacuum sort above PCT percent unsorted rows, default 10
+            -a PCT / --stats PCT : analyze above PCT percent stats_off, default 10
+            -d PCT / --deleted PCT : vacuum delete above PCT percent deleted rows, default 10"""
+    opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 's:u:a:d:', ['schema=', 'unsorted=', 'stats=', 'deleted='])
+    schema, limits = 'public', {'unsorted_max': unsorted_threshold, 'stats_max': stats_threshold, 'deleted_max': deleted_threshold}
+    for o, p in opts:
+        if o in ('-s', '--schema'):
+            schema = p
+        if o in ('-u', '--unsorted'):
+            limits['unsorted_max'] = float(p)
+        if o in ('-a', '--stats'):
+            limits['stats_max'] = float(p)
+        if o in ('-d', '--deleted'):
+            limits['deleted_max'] = float(p)
+    conn, cur = connect_dwh(schema)
+    run_maintenance(cur, conn, analytics_tables + staging_tables, **limits)
+    flush(cur, conn)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
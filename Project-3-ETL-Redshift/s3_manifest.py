@@ -0,0 +1,124 @@
+import json
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""The module "s3_manifest.py" builds Redshift COPY manifests instead of loading whole S3 prefixes:
+- The prefix is split into sub-prefixes (e.g. song-data/A/B/) which are listed in parallel threads
+- Only JSON files are kept, every manifest entry carries the object size (meta content_length)
+- A slice loads one file at a time and Redshift decides which slice loads which file, so only the
+  number of files compared to the number of slices is checked
+- The manifest is uploaded to S3 and used by "copy ... manifest" (see "sql_queries.py")
+"""
+
+
+def split_s3_url(url):
+    """ Splits an url like s3://bucket/prefix into bucket and prefix
+        Returns: bucket, prefix"""
+    path = url[len('s3://'):] if url.startswith('s3://') else url
+    bucket, _, prefix = path.partition('/')
+    return bucket, prefix
+
+
+def list_sub_prefixes(s3client, bucket, prefix, depth=2):
+    """ Walks down the "directories" below prefix for depth levels using the "/" delimiter
+        Objects found on the way (files directly below a level) are returned as well,
+        the returned sub-prefixes still have to be listed
+        Returns: list of sub-prefixes, list of objects"""
+    prefixes, objects = [prefix], []
+    paginator = s3client.get_paginator('list_objects_v2')
+    for level in range(depth):
+        next_prefixes = []
+        for p in prefixes:
+            for page in paginator.paginate(Bucket=bucket, Prefix=p, Delimiter='/'):
+                next_prefixes.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
+                objects.extend(page.get('Contents', []))
+        prefixes = next_prefixes
+        if not prefixes:
+            break
+    return prefixes, objects
+
+
+def list_prefix(s3client, bucket, prefix):
+    """ Lists all objects below prefix (no delimiter, all levels)
+        Returns: list of objects as returned by list_objects_v2"""
+    objects = []
+    paginator = s3client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend(page.get('Contents', []))
+    return objects
+
+
+def list_objects_parallel(s3client, bucket, prefix, workers=16, depth=2, suffix='.json'):
+    """ Lists all objects below prefix, the sub-prefixes "depth" levels down are listed
+        by a pool of "workers" threads (boto3 clients are thread safe)
+        Only keys ending with suffix are kept
+        Returns: list of dictionaries with key, url, size and etag sorted by key"""
+    prefixes, objects = list_sub_prefixes(s3client, bucket, prefix, depth)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(lambda p: list_prefix(s3client, bucket, p), prefixes):
+            objects.extend(result)
+    files = [{'key': o['Key'], 'url': 's3://{}/{}'.format(bucket, o['Key']), 'size': o['Size'], 'etag': o['ETag'].strip('"')}
+             for o in objects if o['Key'].endswith(suffix)]
+    files.sort(key=lambda f: f['key'])
+    print(datetime.now(), ': Listed {} files ({} bytes) below s3://{}/{} using {} sub-prefixes'.format(
+        len(files), sum(f['size'] for f in files), bucket, prefix, len(prefixes)))
+    return files
+
+
+def check_file_count(files, slices):
+    """ Warns if the number of files is no multiple of the slice count, Redshift cannot split
+        JSON files, so some slices are idle while the others load their last file
+        Returns: True if every slice gets the same number of files"""
+    slices = max(int(slices), 1)
+    if files and len(files) % slices:
+        print(datetime.now(), ': {} files are no multiple of {} slices, some slices are idle at the end of the copy'.format(
+            len(files), slices))
+        return False
+    return True
+
+
+def build_manifest(files):
+    """ Creates a Redshift COPY manifest from a list of files (url, size)
+        Returns: manifest as dictionary"""
+    return {'entries': [{'url': f['url'], 'mandatory': True,
+                         'meta': {'content_length': f['size']}} for f in files]}
+
+
+def upload_manifest(s3client, manifest, url):
+    """ Writes the manifest as JSON to the given s3:// url
+        Returns: url of the manifest"""
+    bucket, key = split_s3_url(url)
+    s3client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+    print(datetime.now(), ': Wrote manifest with {} entries to {}'.format(len(manifest['entries']), url))
+    return url
+
+
+def get_slice_count(cur):
+    """ Reads the number of slices of the cluster from stv_slices
+        Returns: number of slices"""
+    cur.execute('select count(*) from stv_slices')
+    return int(cur.fetchone()[0])
+
+
+def list_files(s3client, source, workers=16, depth=2):
+    """ Lists the JSON files below the s3:// url source in parallel
+        Returns: list of files, see "list_objects_parallel" """
+    bucket, prefix = split_s3_url(source)
+    return list_objects_parallel(s3client, bucket, prefix, workers, depth)
+
+
+def write_manifest(s3client, files, target, slices):
+    """ Checks the number of files against the slice count and uploads their manifest to the
+        s3:// url target
+        Returns: url of the manifest"""
+    check_file_count(files, slices)
+    return upload_manifest(s3client, build_manifest(files), target)
+
+
+def create_manifest(s3client, source, target, slices, workers=16, depth=2):
+    """ Lists the files below the s3:// url source in parallel and uploads their manifest to
+        the s3:// url target
+        Returns: url of the manifest, list of files"""
+    files = list_files(s3client, source, workers, depth)
+    return write_manifest(s3client, files, target, slices), files
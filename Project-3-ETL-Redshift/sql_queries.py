@@ -15,6 +15,8 @@ time_table_drop = "DROP TABLE IF EXISTS time;"
 staging_events_drop = "DROP TABLE IF EXISTS staging_events"
 staging_songs_drop = "DROP TABLE IF EXISTS staging_songs"
 dashboard_drop = "DROP TABLE IF EXISTS dashboard"
+load_history_drop = "DROP TABLE IF EXISTS load_history"
+song_lookup_drop = "DROP TABLE IF EXISTS song_lookup"
 
 # Lists of tables and fields
 analytics_tables = ['songs', 'users', 'time', 'songplays', 'artists'] 
@@ -36,34 +38,46 @@ songplay_columns=['ts', 'userid', 'level', 'song_id', 'artist_id', 'sessionid',
 # CREATE ANALYTICS TABLES
 dist_schema = ("""CREATE SCHEMA IF NOT EXISTS {};""")
 search_path = ("""SET search_path TO {};""")
+# Layout as recommended by "dist_advisor.py": the small dimensions are copied to every node
+# (diststyle all), songplays is distributed on song_id and sorted by time
 songplay_table_create = (
     """CREATE TABLE IF NOT EXISTS songplays (
-    songplay_id BIGINT IDENTITY(0,1), start_time TIMESTAMP NOT NULL, user_id VARCHAR NOT NULL, level VARCHAR,
-    song_id VARCHAR NOT NULL distkey, artist_id VARCHAR NOT NULL, session_id VARCHAR, location VARCHAR,
+    songplay_id BIGINT IDENTITY(0,1), start_time TIMESTAMP NOT NULL, user_id INT NOT NULL, level VARCHAR,
+    song_id VARCHAR NOT NULL, artist_id VARCHAR NOT NULL, session_id VARCHAR, location VARCHAR,
     user_agent VARCHAR, PRIMARY KEY (songplay_id)
-    );"""
+    )
+    diststyle key distkey (song_id)
+    compound sortkey (start_time, song_id);"""
 )
 user_table_create = (
     """CREATE TABLE IF NOT EXISTS users (
-    user_id INT sortkey, first_name VARCHAR, last_name VARCHAR, gender VARCHAR, level VARCHAR, PRIMARY KEY (user_id)
-    );"""
+    user_id INT, first_name VARCHAR, last_name VARCHAR, gender VARCHAR, level VARCHAR, PRIMARY KEY (user_id)
+    )
+    diststyle all
+    compound sortkey (user_id);"""
 )
 song_table_create = (
     """CREATE TABLE IF NOT EXISTS songs (
-    song_id VARCHAR  sortkey, title VARCHAR NOT NULL, artist_id VARCHAR, year INT, duration FLOAT, PRIMARY KEY (song_id)
-    );"""
+    song_id VARCHAR, title VARCHAR NOT NULL, artist_id VARCHAR, year INT, duration FLOAT, PRIMARY KEY (song_id)
+    )
+    diststyle all
+    compound sortkey (song_id);"""
 )
 artist_table_create = (
     """CREATE TABLE IF NOT EXISTS artists (
-    artist_id VARCHAR sortkey, artist_name VARCHAR NOT NULL, location VARCHAR, latitude FLOAT,
+    artist_id VARCHAR, artist_name VARCHAR NOT NULL, location VARCHAR, latitude FLOAT,
     longitude FLOAT, PRIMARY KEY (artist_id)
-    );"""
+    )
+    diststyle all
+    compound sortkey (artist_id);"""
 )
 time_table_create = (
     """CREATE TABLE IF NOT EXISTS time (
-    start_time TIMESTAMP sortkey, hour INT, day INT, week INT, month INT, year INT,
+    start_time TIMESTAMP, hour INT, day INT, week INT, month INT, year INT,
     weekday INT, PRIMARY KEY (start_time)
-    );"""
+    )
+    diststyle all
+    compound sortkey (start_time);"""
 )
 
 # CREATE STAGING TABLES
@@ -104,10 +118,20 @@ staging_songs_table_create = (
         );"""
 )
 
-# Create dashboard table
+# Create dashboard table, one row per ETL step (see "telemetry.py")
 dashboard_create = (
     """create table dashboard (
-    step VARCHAR, runtime FLOAT)""")
+    step VARCHAR, runtime FLOAT, row_count BIGINT, bytes_scanned BIGINT, query_ids VARCHAR(1024),
+    started_at TIMESTAMP, saved_mb BIGINT)""")
+
+# Load history of the incremental load, one row per S3 object (url and ETag) copied into staging
+load_history_create = (
+    """CREATE TABLE IF NOT EXISTS load_history (
+    s3_key VARCHAR(1024) NOT NULL, etag VARCHAR(64), size BIGINT, loaded_at TIMESTAMP
+    );"""
+)
+load_history_select = ("""select s3_key, etag from load_history;""")
+load_history_insert = ("""insert into load_history (s3_key, etag, size, loaded_at) values {};""")
 
 # STAGING TABLES INSERT
 staging_songs_copy = (
@@ -135,40 +159,121 @@ staging_events_copy = (
     ;"""
 )
 
+# STAGING TABLES INSERT FROM MANIFEST (see "s3_manifest.py")
+staging_songs_copy_manifest = (
+    """copy staging_songs
+    from '{0}'
+    iam_role '{1}'
+    region 'us-west-2'
+    manifest
+    format as json 'auto ignorecase'
+    compupdate off
+    blanksasnull
+    emptyasnull
+    ;"""
+)
+staging_events_copy_manifest = (
+    """
+    copy staging_events
+    from '{0}'
+    iam_role '{1}'
+    region 'us-west-2'
+    manifest
+    format as json 's3://udacity-dend/log_json_path.json'
+    timeformat as 'epochmillisecs'
+    compupdate off
+    blanksasnull
+    emptyasnull
+    ;"""
+)
+
+# SONG LOOKUP
+# Events are matched to songs by equality on a normalized key (lowercased title and artist name,
+# duration rounded to seconds), the lookup table is distributed on that key for a hash join
+song_key = ("""md5(lower(trim({0})) || '|' || lower(trim({1})) || '|' || round({2})::int::varchar)""")
+staging_song_key = song_key.format('s.title', 's.artist_name', 's.duration')
+event_song_key = song_key.format('e.song', 'e.artist', 'e.length')
+song_lookup_create = (
+    """CREATE TABLE IF NOT EXISTS song_lookup (
+    song_key CHAR(32) NOT NULL distkey sortkey, song_id VARCHAR NOT NULL, artist_id VARCHAR NOT NULL
+    );"""
+)
+song_lookup_truncate = ("""truncate song_lookup;""")
+# One row per key (the lowest song_id), so a play never matches two songs
+song_lookup_insert = (
+    """insert into song_lookup
+    select song_key, song_id, artist_id
+    from (
+        select {0} as song_key, s.song_id, s.artist_id,
+        row_number() over (partition by {0} order by s.song_id) as row_num
+        from staging_songs as s
+        where (s.song_id, s.artist_id, s.title, s.artist_name, s.duration) is not null
+        )
+    where row_num = 1
+    ;""".format(staging_song_key)
+)
+song_match_count = (
+    """select count(*), sum(case when l.song_key is not null then 1 else 0 end)
+    from staging_events as e
+    left join (select distinct song_key from song_lookup) as l
+    on l.song_key = {0}
+    where e.page like 'NextSong'
+    ;""".format(event_song_key)
+)
+
 # ANALYTICS TABLES INSERTS
 songplay_table_insert = (
     """insert into songplays (
     start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
-    select e.ts, e.userid, e.level, s.song_id, s.artist_id, e.sessionid, e.location, e.useragent
+    select e.ts, e.userid, e.level, l.song_id, l.artist_id, e.sessionid, e.location, e.useragent
     from staging_events as e
-    join staging_songs as s
-    on e.song like s.title
-    where e.page like 'NextSong' and e.song is not null and s.artist_id is not null
-    and e.artist like s.artist_name
-    ;"""
+    join song_lookup as l
+    on l.song_key = {0}
+    where e.page like 'NextSong'
+    ;""".format(event_song_key)
 )
-user_table_insert = (
-    """insert into users
-    select e.userid::integer, e.firstname, e.lastname, e.gender, e.level
-    from staging_events as e
-    where (firstname, lastname) is not null
-    and e.page like 'NextSong'
-                        ;""")
-song_table_insert = (
+# Dimension tables are de-duplicated while inserting: row_number() keeps one row per key,
+# keys already in the table are replaced (users, to keep the latest level) or skipped (songs, artists)
+user_table_upsert = (
+    """begin;
+    create temp table upsert_users as
+    select user_id, first_name, last_name, gender, level
+    from (
+        select e.userid::integer as user_id, e.firstname as first_name, e.lastname as last_name,
+        e.gender, e.level, row_number() over (partition by e.userid order by e.ts desc) as row_num
+        from staging_events as e
+        where (e.firstname, e.lastname) is not null and e.userid is not null
+        and e.page like 'NextSong'
+        )
+    where row_num = 1;
+    delete from users using upsert_users where users.user_id = upsert_users.user_id;
+    insert into users select * from upsert_users;
+    drop table upsert_users;
+    end;""")
+song_table_upsert = (
     """insert into songs
     select song_id, title, artist_id, year, duration
-    from staging_songs
-    where (song_id, title) is not null
+    from (
+        select s.song_id, s.title, s.artist_id, s.year, s.duration,
+        row_number() over (partition by s.song_id order by s.year desc, s.duration) as row_num
+        from staging_songs as s
+        where (s.song_id, s.title) is not null
+        and not exists (select 1 from songs as t where t.song_id = s.song_id)
+        )
+    where row_num = 1
     ;"""
 )
-artist_table_insert = (
+artist_table_upsert = (
     """insert into artists
     select artist_id, artist_name, artist_location, artist_latitude, artist_longitude
-    from staging_songs as s
-    join staging_events as e
-    on s.title like e.song
-    where (s.artist_id, s.artist_name) is not null
-    and e.page like 'NextSong'
+    from (
+        select s.artist_id, s.artist_name, s.artist_location, s.artist_latitude, s.artist_longitude,
+        row_number() over (partition by s.artist_id order by s.artist_name, s.artist_location) as row_num
+        from staging_songs as s
+        where (s.artist_id, s.artist_name) is not null
+        and not exists (select 1 from artists as a where a.artist_id = s.artist_id)
+        )
+    where row_num = 1
     ;"""
 )
 time_table_insert = (
@@ -186,118 +291,137 @@ time_table_insert = (
     ;"""
 )
 
-# Duplicate remove action
-table_new_drop = ("""drop table if exists new_{0}""")
-table_temp_drop = ("""drop table if exists temp_{0}""")
-table_temp_create = (
-    """create temp table duplicate_{0} as
-    select {1}
-    from {0}
-    group by {1}
-    having count(*) > 1
-    ;"""
+# DELTA MERGE OF THE INCREMENTAL LOAD
+# Both staging tables only hold the new or changed files, so every merge reads the delta only.
+# song_lookup is kept between runs, so new events still find songs loaded in earlier runs.
+# Songs and artists of the delta replace their rows, keys already in the lookup keep their song
+staging_events_truncate = ("""truncate staging_events;""")
+staging_songs_truncate = ("""truncate staging_songs;""")
+song_lookup_merge = (
+    """begin;
+    delete from song_lookup using staging_songs as s where song_lookup.song_id = s.song_id;
+    insert into song_lookup
+    select song_key, song_id, artist_id
+    from (
+        select {0} as song_key, s.song_id, s.artist_id,
+        row_number() over (partition by {0} order by s.song_id) as row_num
+        from staging_songs as s
+        where (s.song_id, s.artist_id, s.title, s.artist_name, s.duration) is not null
+        ) as n
+    where row_num = 1
+    and not exists (select 1 from song_lookup as l where l.song_key = n.song_key);
+    end;""".format(staging_song_key)
 )
-table_new_create = ("""create temp table new_{0} (like {0});""")
-table_new_insert = (
-    """insert into new_{0}
-    select distinct *
-    from {0}
-    where {1} is not null and {1} in (
-        SELECT {1}
-        FROM duplicate_{0}
+song_table_merge = (
+    """begin;
+    create temp table merge_songs as
+    select song_id, title, artist_id, year, duration
+    from (
+        select s.song_id, s.title, s.artist_id, s.year, s.duration,
+        row_number() over (partition by s.song_id order by s.year desc, s.duration) as row_num
+        from staging_songs as s
+        where (s.song_id, s.title) is not null
         )
-        ;"""
+    where row_num = 1;
+    delete from songs using merge_songs where songs.song_id = merge_songs.song_id;
+    insert into songs select * from merge_songs;
+    drop table merge_songs;
+    end;""")
+artist_table_merge = (
+    """begin;
+    create temp table merge_artists as
+    select artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+    from (
+        select s.artist_id, s.artist_name, s.artist_location, s.artist_latitude, s.artist_longitude,
+        row_number() over (partition by s.artist_id order by s.artist_name, s.artist_location) as row_num
+        from staging_songs as s
+        where (s.artist_id, s.artist_name) is not null
+        )
+    where row_num = 1;
+    delete from artists using merge_artists where artists.artist_id = merge_artists.artist_id;
+    insert into artists select * from merge_artists;
+    drop table merge_artists;
+    end;""")
+time_table_insert_delta = (
+    """insert into time
+    select distinct e.ts as start_time,
+    extract (hour from start_time) as hour,
+    extract (day from start_time) as day,
+    extract (week from start_time) as week,
+    extract (month from start_time) as month,
+    extract (year from start_time) as year,
+    extract (dow from start_time) as weekday
+    from staging_events as e
+    where e.ts is not null
+    and e.page like 'NextSong'
+    and not exists (select 1 from time as t where t.start_time = e.ts)
+    ;"""
 )
-table_delete = (
-    """delete from {0}
-    where {1} is not null and {1} in (
-        select {1}
-        from duplicate_{0}
+# A changed log object is copied again as a whole, its events already in songplays are skipped
+songplay_table_insert_delta = (
+    """insert into songplays (
+    start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    select e.ts, e.userid, e.level, l.song_id, l.artist_id, e.sessionid, e.location, e.useragent
+    from staging_events as e
+    join song_lookup as l
+    on l.song_key = {0}
+    where e.page like 'NextSong'
+    and not exists (
+        select 1 from songplays as p
+        where p.start_time = e.ts and p.user_id = e.userid and p.session_id = e.sessionid::varchar
         )
-        ;"""
+    ;""".format(event_song_key)
 )
-table_unique_insert = (
-    """insert into {0} select * from new_{0};
-    """)
 
-create_redshift_tables = [(
-    """CREATE TABLE public.artists ( artistid varchar(256) NOT NULL, name varchar(256), location varchar(256), lattitude numeric(18,0), longitude numeric(18,0)); """),
-    ("""CREATE TABLE public.songplays (
-        playid varchar(32) NOT NULL,
-        start_time timestamp NOT NULL,
-        userid int4 NOT NULL,
-        level varchar(256),
-        songid varchar(256),
-        artistid varchar(256),
-        sessionid int4,
-        location varchar(256),
-        user_agent varchar(256),
-        CONSTRAINT songplays_pkey PRIMARY KEY (playid)
-    );
-    CREATE TABLE public.songs (
-        songid varchar(256) NOT NULL,
-        title varchar(256),
-        artistid varchar(256),
-        "year" int4,
-        duration numeric(18,0),
-        CONSTRAINT songs_pkey PRIMARY KEY (songid)
-    );
-    CREATE TABLE public.staging_events (
-        artist varchar(256),
-        auth varchar(256),
-        firstname varchar(256),
-        gender varchar(256),
-        iteminsession int4,
-        lastname varchar(256),
-        length numeric(18,0),
-        "level" varchar(256),
-        location varchar(256),
-        "method" varchar(256),
-        page varchar(256),
-        registration numeric(18,0),
-        sessionid int4,
-        song varchar(256),
-        status int4,
-        ts int8,
-        useragent varchar(256),
-        userid int4
-    );
-    CREATE TABLE public.staging_songs (
-        num_songs int4,
-        artist_id varchar(256),
-        artist_name varchar(256),
-        artist_latitude numeric(18,0),
-        artist_longitude numeric(18,0),
-        artist_location varchar(256),
-        song_id varchar(256),
-        title varchar(256),
-        duration numeric(18,0),
-        "year" int4
-    );
-    CREATE TABLE public."time" (
-        start_time timestamp NOT NULL,
-        "hour" int4,
-        "day" int4,
-        week int4,
-        "month" varchar(256),
-        "year" int4,
-        weekday varchar(256),
-        CONSTRAINT time_pkey PRIMARY KEY (start_time)
-    );
-    CREATE TABLE public.users (
-        userid int4 NOT NULL,
-        first_name varchar(256),
-        last_name varchar(256),
-        gender varchar(256),
-        "level" varchar(256),
-        CONSTRAINT users_pkey PRIMARY KEY (userid)
-    );
-""")]
+# COMPRESSION ANALYSIS (see "compression.py")
+analyze_compression = ("""analyze compression {0} comprows {1};""")
+table_encoding_select = ("""select "column", type, encoding from pg_table_def where tablename = %s;""")
+table_size_select = ("""select size from svv_table_info where "table" = %s;""")
+
+# TABLE MAINTENANCE (see "maintenance.py")
+table_maintenance_select = ("""select "table", unsorted, stats_off, tbl_rows, estimated_visible_rows from svv_table_info;""")
+vacuum_sort_only = ("""vacuum sort only {0};""")
+vacuum_delete_only = ("""vacuum delete only {0};""")
+vacuum_full = ("""vacuum full {0};""")
+analyze_predicate_columns = ("""analyze {0} predicate columns;""")
+
+# STEP TELEMETRY (see "telemetry.py")
+# Every step runs in its own query group, stl_query keeps the group as label (padded with blanks)
+set_query_group = ("""set query_group to '{}';""")
+reset_query_group = ("""reset query_group;""")
+step_queries_select = ("""select query from stl_query where trim(label) = %s order by query;""")
+# Rows written by insert and delete steps and bytes read by scan steps of the given queries
+step_metrics_select = (
+    """select coalesce(sum(case when label like 'insert%' or label like 'delete%' then rows end), 0),
+    coalesce(sum(case when label like 'scan%' then bytes end), 0)
+    from svl_query_summary
+    where query in ({0});"""
+)
+copy_count_select = ("""select pg_last_copy_count();""")
+dashboard_insert = ("""insert into dashboard (step, runtime, row_count, bytes_scanned, query_ids, started_at, saved_mb) values {};""")
 
 # QUERY LISTS
-create_table_queries = [dashboard_create, staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [dashboard_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, staging_events_drop, staging_songs_drop]
+create_table_queries = [dashboard_create, load_history_create, song_lookup_create, staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
+drop_table_queries = [dashboard_drop, load_history_drop, song_lookup_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, staging_events_drop, staging_songs_drop]
+analytics_table_creates = {'songplays': songplay_table_create, 'users': user_table_create, 'songs': song_table_create,
+                           'artists': artist_table_create, 'time': time_table_create}
 reset_analytics_tables = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [user_table_insert, song_table_insert, artist_table_insert, time_table_insert, songplay_table_insert]
-remove_duplicates = [table_new_drop, table_temp_drop, table_temp_create, table_new_create, table_new_insert, table_delete, table_unique_insert]
+song_lookup_queries = [song_lookup_create, song_lookup_truncate, song_lookup_insert]
+insert_table_queries = song_lookup_queries + [user_table_upsert, song_table_upsert, artist_table_upsert, time_table_insert, songplay_table_insert]
+song_lookup_merge_queries = [song_lookup_create, song_lookup_merge]
+merge_table_queries = song_lookup_merge_queries + [user_table_upsert, song_table_merge, artist_table_merge, time_table_insert_delta, songplay_table_insert_delta]
+
+# Dependency graph of the analytics inserts (node: queries, nodes it depends on), see "dag_executor.py"
+# The dimensions are independent of each other, songplays starts after all dimensions are done
+insert_table_graph = {
+    'song_lookup': (song_lookup_queries, []),
+    'users': ([user_table_upsert], []),
+    'songs': ([song_table_upsert], []),
+    'artists': ([artist_table_upsert], []),
+    'time': ([time_table_insert], []),
+    'songplays': ([songplay_table_insert], ['song_lookup', 'users', 'songs', 'artists', 'time']),
+}
+merge_table_graph = dict(insert_table_graph, song_lookup=(song_lookup_merge_queries, []), songs=([song_table_merge], []),
+                         artists=([artist_table_merge], []), time=([time_table_insert_delta], []),
+                         songplays=([songplay_table_insert_delta], insert_table_graph['songplays'][1]))
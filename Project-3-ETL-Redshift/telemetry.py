@@ -0,0 +1,157 @@
+import json
+import uuid
+from time import time
+from itertools import count
+from datetime import datetime
+from sql_queries import set_query_group, reset_query_group, step_queries_select, step_metrics_select, \
+    copy_count_select, dashboard_insert
+
+
+"""The module "telemetry.py" measures every step of the ETL run (COPY, inserts, upserts, vacuum, analyze):
+- "step" is a context manager, it records the wall time of a step and sets a query group with a label
+  unique to the step on the connection, a step nested in another one sets its own label and restores
+  the outer label afterwards, so no query is counted twice
+- Nodes of the parallel inserts run on other connections, their queries are labelled with "label_queries"
+  and the nodes are added with "add_step"
+- "flush" reads the queries of every step from stl_query (by label) and their rows written and bytes
+  scanned from svl_query_summary, writes all steps with one insert into the dashboard table and appends
+  them as JSON lines to a file
+"""
+
+steps = []
+# Labels are unique per run, stl_query keeps the queries of earlier runs for some days
+run_id = uuid.uuid4().hex[:8]
+step_numbers = count(1)
+# Current query group per connection, to restore the label of the outer step
+query_groups = {}
+
+
+def new_label():
+    """ Returns: a query group label which is unique to one step"""
+    return 'etl {} {}'.format(run_id, next(step_numbers))
+
+
+class Step:
+    """ One measured step, used as context manager (see "step")
+        rows can be set inside the with block, e.g. to the row count of a COPY, and then
+        replaces the rows read from svl_query_summary"""
+
+    def __init__(self, name, cur=None, runtime=None, label=None):
+        self.name, self.cur, self.runtime = name, cur, runtime
+        self.label = label or new_label()
+        self.started, self.ended = None, None
+        self.rows, self.bytes_scanned, self.query_ids, self.failed = None, None, [], False
+        # Storage saved by the step in MB, e.g. by a compression rebuild (see "compression.py")
+        self.saved_mb = None
+
+    def __enter__(self):
+        if self.cur is not None:
+            self.outer = query_groups.get(id(self.cur.connection))
+            self.cur.execute(set_query_group.format(self.label))
+            query_groups[id(self.cur.connection)] = self.label
+        self.started = datetime.utcnow()
+        self.t0 = time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.runtime = time() - self.t0
+        self.ended = datetime.utcnow()
+        self.failed = exc_type is not None
+        if self.cur is not None:
+            try:
+                if self.outer:
+                    self.cur.execute(set_query_group.format(self.outer))
+                else:
+                    self.cur.execute(reset_query_group)
+            except Exception as e:
+                print(datetime.now(), ': Could not restore the query group after step ', self.name, ' raising: ', e)
+            query_groups[id(self.cur.connection)] = self.outer
+        steps.append(self)
+        print(datetime.now(), ': {} {} in {:.1f}s'.format(self.name, 'failed' if self.failed else 'finished', self.runtime))
+        return False
+
+    def record(self):
+        """ Returns: the step as dictionary, as written to the JSON lines file"""
+        return {'step': self.name, 'runtime': self.runtime, 'rows': self.rows, 'bytes_scanned': self.bytes_scanned,
+                'query_ids': self.query_ids, 'saved_mb': self.saved_mb, 'label': self.label, 'failed': self.failed,
+                'started_at': self.started.isoformat() if self.started else None,
+                'ended_at': self.ended.isoformat() if self.ended else None}
+
+
+def step(name, cur=None):
+    """ Measures the statements run in a with block on the connection of cur
+        Returns: Step"""
+    return Step(name, cur)
+
+
+def label_queries(queries, label):
+    """ Wraps the queries of a step running on another connection into its query group
+        Returns: list of queries"""
+    return [set_query_group.format(label)] + list(queries) + [reset_query_group]
+
+
+def add_step(name, runtime, label=None):
+    """ Adds a step measured somewhere else, e.g. a node of "dag_executor.py" whose queries
+        were wrapped by "label_queries"
+        Returns: Step"""
+    s = Step(name, None, runtime, label)
+    steps.append(s)
+    return s
+
+
+def copy_count(cur):
+    """ Reads the number of rows loaded by the last COPY of the session
+        Returns: number of rows"""
+    cur.execute(copy_count_select)
+    return int(cur.fetchone()[0])
+
+
+def query_metrics(cur, s):
+    """ Finds the queries of a step in stl_query by its label and sums their rows written and bytes scanned
+        Returns: list of query ids, rows, bytes"""
+    cur.execute(step_queries_select, (s.label,))
+    query_ids = [int(row[0]) for row in cur.fetchall()]
+    if not query_ids:
+        return query_ids, 0, 0
+    cur.execute(step_metrics_select.format(', '.join(str(q) for q in query_ids)))
+    rows, scanned = cur.fetchone()
+    return query_ids, int(rows or 0), int(scanned or 0)
+
+
+def flush(cur=None, conn=None, path='etl_metrics.jsonl'):
+    """ Completes the measured steps with the metrics of the system tables, writes them into the
+        dashboard table with one insert and appends them to the JSON lines file path
+        Without a cursor only wall times are exported
+        Returns: list of the exported steps as dictionaries"""
+    for s in steps:
+        if cur is None:
+            break
+        try:
+            query_ids, rows, scanned = query_metrics(cur, s)
+            s.query_ids, s.bytes_scanned = query_ids, scanned
+            s.rows = rows if s.rows is None else s.rows
+        except Exception as e:
+            print(datetime.now(), ': Could not read metrics of step ', s.name, ' raising: ', e)
+            cur.execute('rollback')
+    if cur is not None and steps:
+        values = ', '.join(cur.mogrify('(%s, %s, %s, %s, %s, %s, %s)', (
+            s.name[:256], s.runtime, s.rows, s.bytes_scanned, ','.join(str(q) for q in s.query_ids)[:1024], s.started,
+            s.saved_mb)).decode('utf-8') for s in steps)
+        try:
+            cur.execute(dashboard_insert.format(values))
+            conn.commit()
+        except Exception as e:
+            # A dashboard table of an older run lacks the metric columns, run "create_tables.py"
+            print(datetime.now(), ': Could not write steps to dashboard raising: ', e)
+            cur.execute('rollback')
+    records = [s.record() for s in steps]
+    with open(path, 'a') as f:
+        for r in records:
+            f.write(json.dumps(r) + '\n')
+    print(datetime.now(), ': Wrote ', len(records), ' steps to ', path)
+    slowest = max(steps, key=lambda s: s.runtime or 0, default=None)
+    if slowest:
+        print(datetime.now(), ': Slowest step: {} ({:.1f}s, {} rows, {} bytes scanned)'.format(
+            slowest.name, slowest.runtime, slowest.rows, slowest.bytes_scanned))
+    del steps[:]
+    return records
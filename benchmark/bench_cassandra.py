@@ -0,0 +1,151 @@
+"""The script "bench_cassandra.py" compares the write strategies of Project-2 against a local
+single-node Cassandra or ScyllaDB (e.g. "docker run -p 9042:9042 cassandra" or "scylladb/scylla"):
+- "sync": one session.execute per row and table
+- "async": execute_async with a window of requests in flight, one pass for all tables ("load_all")
+- "batched": UNLOGGED batches per partition through the same window ("load_all" with batching)
+- "concurrent": execute_concurrent_with_args per table ("load_table_concurrent")
+The input is event_datafile_new.csv or a copy scaled up N times, the query tables are truncated
+before every strategy. Rows/s, client CPU and latency percentiles are written to a JSON report
+"""
+import os
+import csv
+import sys
+import getopt
+import tempfile
+from time import perf_counter
+from datetime import datetime
+from common import Stage, new_report, write_report, project_path
+
+project_path('Project-2-Cassandra')
+import cassandra_loader
+
+strategies = ['sync', 'async', 'batched', 'concurrent']
+
+
+def scale_events(source, output, factor):
+    """Writes factor copies of the csv file source to output, sessionId and userId of every copy are
+    shifted beyond the largest values of the source, so no copy overwrites the rows of another one:
+    the session tables get new partitions, user_by_title (partition song_title) gets new rows in the
+    same song partitions, which grow with the factor
+    Returns the number of rows written"""
+    with open(source, encoding='utf8') as f:
+        csvreader = csv.reader(f)
+        header = next(csvreader)
+        lines = list(csvreader)
+    session_column, user_column = header.index('sessionId'), header.index('userId')
+    offset = max(int(line[session_column]) for line in lines) + 1
+    user_offset = max(int(float(line[user_column])) for line in lines if line[user_column]) + 1
+    with open(output, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        for copy in range(factor):
+            for line in lines:
+                line = list(line)
+                line[session_column] = str(int(line[session_column]) + copy * offset)
+                if line[user_column]:
+                    line[user_column] = str(int(float(line[user_column])) + copy * user_offset)
+                writer.writerow(line)
+    print(datetime.now(), ': Wrote {} rows ({} x {}) to {}'.format(factor * len(lines), factor, source, output))
+    return factor * len(lines)
+
+
+def load_sync(session, file, tables):
+    """Loads the csv file with one blocking request per row and table
+    Returns a dictionary with the load statistics per table, like "load_all" """
+    results = {}
+    for table in tables:
+        statement = session.prepare(cassandra_loader.query_tables[table]['insert'])
+        params = cassandra_loader.query_tables[table]['params']
+        latencies = []
+        t0 = perf_counter()
+        for event in cassandra_loader.read_events(file):
+            started = perf_counter()
+            session.execute(statement, params(event))
+            latencies.append(perf_counter() - started)
+        runtime = max(perf_counter() - t0, 1e-6)
+        results[table] = {
+            'rows': len(latencies), 'requests': len(latencies), 'errors': 0, 'seconds': round(runtime, 3),
+            'inserts_per_s': round(len(latencies) / runtime, 1),
+        }
+        for p in (50, 95, 99):
+            value = cassandra_loader.percentile(latencies, p)
+            results[table]['p{}_ms'.format(p)] = round(value * 1000, 3) if latencies else None
+        print(datetime.now(), ': Loaded {} rows into {} ({} inserts/s)'.format(len(latencies), table, results[table]['inserts_per_s']))
+    return results
+
+
+def run_strategy(session, strategy, file, tables, concurrency, batch_rows):
+    """Loads the csv file into the tables with one strategy
+    Returns the load statistics per table"""
+    if strategy == 'sync':
+        return load_sync(session, file, tables)
+    if strategy == 'async':
+        return cassandra_loader.load_all(session, file, tables, concurrency)
+    if strategy == 'batched':
+        return cassandra_loader.load_all(session, file, tables, concurrency, batch_rows)
+    if strategy == 'concurrent':
+        return {table: cassandra_loader.load_table_concurrent(session, table, file, concurrency) for table in tables}
+    raise ValueError('Unknown strategy {}'.format(strategy))
+
+
+def main(argv=None):
+    """Command line options:
+    -f FILE / --file FILE : source csv, default event_datafile_new.csv of Project-2
+    -x N / --scale N : load a copy of the source scaled up N times (e.g. 1000), default 1
+    -s LIST / --strategies LIST : comma separated strategies, default "sync,async,batched,concurrent"
+    -h HOST / --host HOST : contact point, default 127.0.0.1
+    -k NAME / --keyspace NAME : keyspace, default "events_bench"
+    -c N / --concurrency N : requests in flight per table, default 128
+    -b N / --batch N : rows per batch of the "batched" strategy, default 100
+    -r FILE / --report FILE : path of the JSON report, default "bench_cassandra.json" """
+    opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 'f:x:s:h:k:c:b:r:',
+                               ['file=', 'scale=', 'strategies=', 'host=', 'keyspace=', 'concurrency=', 'batch=', 'report='])
+    source = os.path.join(project_path('Project-2-Cassandra'), 'event_datafile_new.csv')
+    scale, modes, host, keyspace, concurrency, batch_rows = 1, strategies, '127.0.0.1', 'events_bench', 128, 100
+    report_path = 'bench_cassandra.json'
+    for o, p in opts:
+        if o in ('-f', '--file'):
+            source = p
+        elif o in ('-x', '--scale'):
+            scale = int(p)
+        elif o in ('-s', '--strategies'):
+            modes = p.split(',')
+        elif o in ('-h', '--host'):
+            host = p
+        elif o in ('-k', '--keyspace'):
+            keyspace = p
+        elif o in ('-c', '--concurrency'):
+            concurrency = int(p)
+        elif o in ('-b', '--batch'):
+            batch_rows = int(p)
+        elif o in ('-r', '--report'):
+            report_path = p
+
+    report = new_report('cassandra', source=source, scale=scale, strategies=modes, host=host,
+                        concurrency=concurrency, batch_rows=batch_rows)
+    file = source
+    if scale > 1:
+        file = os.path.join(tempfile.mkdtemp(prefix='sparkify_cassandra_'), 'event_datafile_scaled.csv')
+        with Stage(report, 'scale data') as stage:
+            stage.rows = scale_events(source, file, scale)
+
+    cluster, session = cassandra_loader.connect(host)
+    session.execute(cassandra_loader.keyspace_create.format(keyspace))
+    session.set_keyspace(keyspace)
+    tables = list(cassandra_loader.query_tables)
+    cassandra_loader.create_tables(session, tables)
+    for strategy in modes:
+        for table in tables:
+            session.execute('TRUNCATE {}'.format(table))
+        with Stage(report, strategy) as stage:
+            results = run_strategy(session, strategy, file, tables, concurrency, batch_rows)
+            stage.rows = sum(r['rows'] for r in results.values())
+            stage.metrics['errors'] = sum(r['errors'] for r in results.values())
+            stage.metrics['tables'] = results
+    session.shutdown()
+    cluster.shutdown()
+    write_report(report, report_path)
+
+
+if __name__ == '__main__':
+    main()
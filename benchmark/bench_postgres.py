@@ -0,0 +1,95 @@
+"""The script "bench_postgres.py" measures the Project-1 ETL against a local Postgres:
+- Generates a synthetic data set (or uses an existing one)
+- Recreates sparkifydb for every load mode ("row", "bulk", "stream")
+- Times loading the song files, building the song index and loading the log files
+- Writes rows/s, files/s and peak RSS of every stage to a JSON report
+"""
+import os
+import sys
+import getopt
+import functools
+import tempfile
+from common import Stage, new_report, write_report, project_path
+from generate_data import generate
+
+project_path('Project-1-Postgres')
+import etl
+import create_tables
+
+log_functions = {
+    'row': etl.process_log_file,
+    'bulk': etl.process_log_file_bulk,
+    'stream': functools.partial(etl.process_log_file_stream, chunksize=10000),
+}
+
+
+def count_rows(cur, tables):
+    """Returns the total number of rows in the given tables"""
+    total = 0
+    for table in tables:
+        cur.execute('SELECT count(*) FROM {}'.format(table))
+        total += cur.fetchone()[0]
+    return total
+
+
+def run_mode(report, mode, data_dir):
+    """Loads the data set into a fresh sparkifydb with the log loader of the given mode"""
+    song_dir = os.path.join(data_dir, 'song_data')
+    log_dir = os.path.join(data_dir, 'log_data')
+    cur, conn = create_tables.create_database()
+    create_tables.drop_tables(cur, conn)
+    create_tables.create_tables(cur, conn)
+    # Every mode starts with an empty time dimension cache
+    etl.time_dimension = etl.TimeDimension()
+
+    with Stage(report, '{}: song files'.format(mode)) as stage:
+        etl.process_data(cur, conn, song_dir, etl.process_song_file, incremental=False)
+        stage.files = len(etl.get_files(song_dir))
+        stage.rows = count_rows(cur, ['songs', 'artists'])
+
+    with Stage(report, '{}: song index'.format(mode)) as stage:
+        song_index = etl.build_song_index(cur)
+        stage.rows = len(song_index)
+
+    with Stage(report, '{}: log files'.format(mode)) as stage:
+        func = functools.partial(log_functions[mode], song_index=song_index)
+        etl.process_data(cur, conn, log_dir, func, incremental=False)
+        stage.files = len(etl.get_files(log_dir))
+        stage.rows = count_rows(cur, ['time', 'users', 'songplays'])
+    conn.close()
+
+
+def main(argv=None):
+    """Command line options:
+    -d DIR / --data DIR : use an existing data set instead of generating one
+    -m MODES / --modes MODES : comma separated load modes, default "row,bulk,stream"
+    -r FILE / --report FILE : path of the JSON report, default "bench_postgres.json"
+    --songs N, --artists N, --users N, --events N, --log-files N : size of the generated data set"""
+    opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 'd:m:r:',
+                               ['data=', 'modes=', 'report=', 'songs=', 'artists=', 'users=', 'events=', 'log-files='])
+    data_dir = None
+    modes = ['row', 'bulk', 'stream']
+    report_path = 'bench_postgres.json'
+    sizes = {}
+    for o, p in opts:
+        if o in ('-d', '--data'):
+            data_dir = p
+        elif o in ('-m', '--modes'):
+            modes = p.split(',')
+        elif o in ('-r', '--report'):
+            report_path = p
+        else:
+            sizes['num_' + o[2:].replace('-', '_')] = int(p)
+
+    report = new_report('postgres', modes=modes, data=data_dir, **sizes)
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='sparkify_')
+        with Stage(report, 'generate data'):
+            report['params']['data_set'] = generate(data_dir, **sizes)
+    for mode in modes:
+        run_mode(report, mode, data_dir)
+    write_report(report, report_path)
+
+
+if __name__ == '__main__':
+    main()
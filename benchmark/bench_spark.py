@@ -0,0 +1,81 @@
+"""The script "bench_spark.py" measures the Project-4 ETL on a local Spark installation:
+- Generates a synthetic data set with the directory layout the Spark job expects
+- Times "process_song_data" and "process_log_data" writing parquet files to a local directory
+- Writes rows/s, files/s and peak RSS of every stage to a JSON report
+Note: Spark runs in a JVM next to this process, the reported peak RSS only covers the Python driver
+"""
+import os
+import sys
+import getopt
+import tempfile
+from common import Stage, new_report, write_report, project_path
+from generate_data import generate
+
+
+def import_spark_etl(workdir):
+    """Imports Project-4 etl.py, which reads AWS credentials from dl.cfg in the working directory
+    at import time, a dummy dl.cfg is written to workdir for local runs
+    Returns the etl module"""
+    project_path('Project-4-Spark')
+    with open(os.path.join(workdir, 'dl.cfg'), 'w') as f:
+        f.write('[AWS]\nAWS_ACCESS_KEY_ID=local\nAWS_SECRET_ACCESS_KEY=local\n')
+    os.chdir(workdir)
+    import etl
+    return etl
+
+
+def count_files(path):
+    """Returns the number of json files below path"""
+    return sum(len([f for f in files if f.endswith('.json')]) for root, dirs, files in os.walk(path))
+
+
+def main(argv=None):
+    """Command line options:
+    -d DIR / --data DIR : use an existing data set (with song_data and log-data) instead of generating one
+    -r FILE / --report FILE : path of the JSON report, default "bench_spark.json"
+    --master URL : Spark master, default "local[*]"
+    --songs N, --artists N, --users N, --events N, --log-files N : size of the generated data set"""
+    opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 'd:r:',
+                               ['data=', 'report=', 'master=', 'songs=', 'artists=', 'users=', 'events=', 'log-files='])
+    data_dir = None
+    report_path = os.path.abspath('bench_spark.json')
+    master = 'local[*]'
+    sizes = {}
+    for o, p in opts:
+        if o in ('-d', '--data'):
+            data_dir = os.path.abspath(p)
+        elif o in ('-r', '--report'):
+            report_path = os.path.abspath(p)
+        elif o == '--master':
+            master = p
+        else:
+            sizes['num_' + o[2:].replace('-', '_')] = int(p)
+
+    report = new_report('spark', master=master, data=data_dir, **sizes)
+    workdir = tempfile.mkdtemp(prefix='sparkify_spark_')
+    if data_dir is None:
+        data_dir = os.path.join(workdir, 'input')
+        with Stage(report, 'generate data'):
+            report['params']['data_set'] = generate(data_dir, log_dirname='log-data', **sizes)
+    output_dir = os.path.join(workdir, 'output') + '/'
+
+    etl = import_spark_etl(workdir)
+    from pyspark.sql import SparkSession
+    spark = SparkSession.builder.master(master).appName('sparkify-benchmark').getOrCreate()
+
+    with Stage(report, 'process_song_data') as stage:
+        etl.process_song_data(spark, data_dir + '/', output_dir)
+        stage.files = count_files(os.path.join(data_dir, 'song_data'))
+        stage.rows = spark.read.parquet(output_dir + 'songs/songs.parquet').count()
+
+    with Stage(report, 'process_log_data') as stage:
+        etl.process_log_data(spark, data_dir + '/', output_dir)
+        stage.files = count_files(os.path.join(data_dir, 'log-data'))
+        stage.rows = spark.read.parquet(output_dir + 'songplays/').count()
+
+    spark.stop()
+    write_report(report, report_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Helpers shared by the benchmark scripts: stage timing, peak memory and the JSON report"""
+import os
+import sys
+import json
+import resource
+from time import time
+from datetime import datetime
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def project_path(name):
+    """Returns the absolute path of a project directory and makes its modules importable"""
+    path = os.path.join(repo_root, name)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return path
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size of this process, so the next stage reports its own peak
+    (Linux only: writing 5 to /proc/self/clear_refs resets VmHWM)
+    Returns True if the peak was reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process (since the last "reset_peak_rss") and of its
+    finished child processes (over the lifetime of the process) in MB"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes everywhere else
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    try:
+        with open('/proc/self/status') as f:
+            own = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+    except (OSError, StopIteration):
+        pass
+    return round(own, 1), round(children / scale, 1)
+
+
+def cpu_seconds():
+    """Returns user plus system CPU time of this process in seconds (all threads, e.g. driver IO threads)"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Stage:
+    """Context manager which times one benchmark stage and adds its result to the report
+    Set "rows" and "files" inside the with block to get rows/s and files/s,
+    further results (e.g. latency percentiles) can be added to the dictionary "metrics"
+    Client CPU time of the stage is always recorded, the peak memory of the process is reset when the stage
+    starts where the platform allows it ("peak_rss_reset")"""
+
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+        self.rows = None
+        self.files = None
+        self.metrics = {}
+
+    def __enter__(self):
+        print(datetime.now(), ': Starting stage', self.name)
+        self.peak_reset = reset_peak_rss()
+        self.t0 = time()
+        self.cpu0 = cpu_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        runtime = max(time() - self.t0, 1e-6)
+        cpu = cpu_seconds() - self.cpu0
+        result = {'stage': self.name, 'seconds': round(runtime, 3),
+                  'cpu_seconds': round(cpu, 3), 'cpu_percent': round(100 * cpu / runtime, 1)}
+        if self.rows is not None:
+            result.update({'rows': self.rows, 'rows_per_s': round(self.rows / runtime, 1)})
+        if self.files is not None:
+            result.update({'files': self.files, 'files_per_s': round(self.files / runtime, 1)})
+        result.update(self.metrics)
+        result['peak_rss_mb'], result['peak_rss_children_mb'] = peak_rss_mb()
+        result['peak_rss_reset'] = self.peak_reset
+        if exc_type is not None:
+            result['error'] = repr(exc)
+        self.report['stages'].append(result)
+        print(datetime.now(), ':', json.dumps(result))
+        return False
+
+
+def new_report(name, **params):
+    """Returns an empty report for the benchmark name with the given parameters"""
+    return {'benchmark': name, 'started': datetime.now().isoformat(), 'params': params, 'stages': []}
+
+
+def write_report(report, path):
+    """Writes the report as JSON to path"""
+    report['finished'] = datetime.now().isoformat()
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(datetime.now(), ': Report written to', path)
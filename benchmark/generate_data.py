@@ -0,0 +1,162 @@
+"""The script "generate_data.py" creates a synthetic Sparkify data set:
+- song_data/<A>/<B>/<C>/<song_id>.json with one song per file (layout of the udacity song data)
+- log_data/<year>/<month>/<date>-events.json with one event per line (layout of the udacity log data)
+The files can be read by "process_song_file"/"process_log_file" of Project-1 and by
+"process_song_data"/"process_log_data" of Project-4 (use log_dirname 'log-data' for Spark)
+"""
+import os
+import sys
+import json
+import random
+import getopt
+from datetime import datetime, timedelta
+
+first_names = ['Jayden', 'Jacob', 'Lily', 'Ava', 'Kate', 'Ryan', 'Tegan', 'Chloe', 'Aleena', 'Mohammad']
+last_names = ['Bell', 'Klein', 'Koch', 'Robinson', 'Harrell', 'Smith', 'Levine', 'Cuevas', 'Kirby', 'Rodriguez']
+locations = ['Dallas-Fort Worth-Arlington, TX', 'Tampa-St. Petersburg-Clearwater, FL', 'San Francisco-Oakland-Hayward, CA',
+             'Portland-South Portland, ME', 'Lansing-East Lansing, MI', 'Chicago-Naperville-Elgin, IL-IN-WI']
+user_agents = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9; rv:31.0) Gecko/20100101 Firefox/31.0',
+               '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"']
+words = ['Love', 'Night', 'Fire', 'Heart', 'Dream', 'Rain', 'Shell', 'Shock', 'Dead', 'Blue', 'Road', 'Home', 'Light', 'Fix', 'You']
+other_pages = ['Home', 'Logout', 'Settings', 'Add to Playlist', 'Thumbs Up', 'About']
+
+
+def random_id(rnd, prefix, length=16):
+    """Returns an id in the style of the million song data set, e.g. SOABCDEF12345678"""
+    return prefix + ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for i in range(length))
+
+
+def make_artists(rnd, num_artists):
+    """Returns a list of artist dictionaries with the artist columns of a song file"""
+    artists = []
+    for i in range(num_artists):
+        has_coordinates = rnd.random() < 0.4
+        artists.append({
+            'artist_id': random_id(rnd, 'AR'),
+            'artist_latitude': round(rnd.uniform(-60, 60), 5) if has_coordinates else None,
+            'artist_longitude': round(rnd.uniform(-150, 150), 5) if has_coordinates else None,
+            'artist_location': rnd.choice(locations) if rnd.random() < 0.6 else '',
+            'artist_name': '{} {} {}'.format(rnd.choice(words), rnd.choice(words), i),
+        })
+    return artists
+
+
+def make_songs(rnd, num_songs, artists):
+    """Returns a list of song records as stored in the song files"""
+    songs = []
+    for i in range(num_songs):
+        song = {'num_songs': 1}
+        song.update(rnd.choice(artists))
+        song.update({
+            'song_id': random_id(rnd, 'SO'),
+            'title': '{} {} {}'.format(rnd.choice(words), rnd.choice(words), i),
+            'duration': round(rnd.uniform(60, 600), 5),
+            'year': rnd.choice([0, rnd.randint(1960, 2018)]),
+        })
+        songs.append(song)
+    return songs
+
+
+def make_users(rnd, num_users):
+    """Returns a list of user dictionaries with the user columns of a log event"""
+    return [{
+        'userId': str(i + 1),
+        'firstName': rnd.choice(first_names),
+        'lastName': rnd.choice(last_names),
+        'gender': rnd.choice(['M', 'F']),
+        'level': rnd.choice(['free', 'paid']),
+        'location': rnd.choice(locations),
+        'userAgent': rnd.choice(user_agents),
+        'registration': float(rnd.randint(1530000000000, 1540000000000)),
+    } for i in range(num_users)]
+
+
+def make_event(rnd, ts, session_id, item, user, songs, next_song_ratio):
+    """Returns one log event, NextSong events reference a song of the song data set"""
+    event = {
+        'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'], 'gender': user['gender'],
+        'itemInSession': item, 'lastName': user['lastName'], 'length': None, 'level': user['level'],
+        'location': user['location'], 'method': 'GET', 'page': rnd.choice(other_pages), 'registration': user['registration'],
+        'sessionId': session_id, 'song': None, 'status': 200, 'ts': ts, 'userAgent': user['userAgent'], 'userId': user['userId'],
+    }
+    if rnd.random() < next_song_ratio:
+        song = rnd.choice(songs)
+        event.update({'artist': song['artist_name'], 'length': song['duration'], 'method': 'PUT',
+                      'page': 'NextSong', 'song': song['title']})
+    return event
+
+
+def write_song_files(songs, song_dir):
+    """Writes one json file per song into the three letter subdirectories of song_dir"""
+    for song in songs:
+        path = os.path.join(song_dir, song['song_id'][2], song['song_id'][3], song['song_id'][4])
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, song['song_id'] + '.json'), 'w') as f:
+            f.write(json.dumps(song))
+
+
+def write_log_files(rnd, songs, users, num_events, num_files, log_dir, next_song_ratio=0.8, start=datetime(2018, 11, 1)):
+    """Writes num_events events spread evenly over num_files daily log files below log_dir/<year>/<month>
+    Events of a file are ordered by timestamp and grouped into sessions of the same user"""
+    per_file = max(1, num_events // num_files) if num_files else 0
+    written = 0
+    session_id = 0
+    for day in range(num_files):
+        date = start + timedelta(days=day)
+        path = os.path.join(log_dir, str(date.year), '{:02d}'.format(date.month))
+        os.makedirs(path, exist_ok=True)
+        count = per_file if day < num_files - 1 else num_events - written
+        ts = int(date.timestamp() * 1000)
+        item = 0
+        with open(os.path.join(path, date.strftime('%Y-%m-%d') + '-events.json'), 'w') as f:
+            for i in range(count):
+                if item == 0 or rnd.random() < 0.05:
+                    session_id += 1
+                    item = 0
+                    user = rnd.choice(users)
+                ts += rnd.randint(1000, 300000)
+                f.write(json.dumps(make_event(rnd, ts, session_id, item, user, songs, next_song_ratio)) + '\n')
+                item += 1
+        written += count
+
+
+def generate(output_dir, num_songs=1000, num_artists=200, num_users=100, num_events=10000, num_log_files=30,
+             log_dirname='log_data', seed=42):
+    """Creates the directories song_data and log_data (or log_dirname) below output_dir
+    Returns a dictionary describing the generated data set"""
+    rnd = random.Random(seed)
+    artists = make_artists(rnd, num_artists)
+    songs = make_songs(rnd, num_songs, artists)
+    users = make_users(rnd, num_users)
+    write_song_files(songs, os.path.join(output_dir, 'song_data'))
+    write_log_files(rnd, songs, users, num_events, num_log_files, os.path.join(output_dir, log_dirname))
+    return {'songs': num_songs, 'artists': num_artists, 'users': num_users, 'events': num_events,
+            'song_files': num_songs, 'log_files': num_log_files, 'seed': seed}
+
+
+def main(argv=None):
+    """Command line options:
+    -o DIR / --output DIR : target directory (default "synthetic_data")
+    --songs N, --artists N, --users N, --events N, --log-files N : size of the data set
+    --log-dirname NAME : name of the log directory, "log_data" (Project-1) or "log-data" (Project-4)
+    --seed N : seed of the random generator, the same seed creates the same data set"""
+    opts, args = getopt.getopt(sys.argv[1:] if argv is None else argv, 'o:',
+                               ['output=', 'songs=', 'artists=', 'users=', 'events=', 'log-files=', 'log-dirname=', 'seed='])
+    output_dir = 'synthetic_data'
+    params = {}
+    names = {'--songs': 'num_songs', '--artists': 'num_artists', '--users': 'num_users', '--events': 'num_events',
+             '--log-files': 'num_log_files', '--seed': 'seed'}
+    for o, p in opts:
+        if o in ('-o', '--output'):
+            output_dir = p
+        elif o == '--log-dirname':
+            params['log_dirname'] = p
+        else:
+            params[names[o]] = int(p)
+    print(datetime.now(), ': Generating data set in', output_dir)
+    print(datetime.now(), ':', json.dumps(generate(output_dir, **params)))
+
+
+if __name__ == '__main__':
+    main()